@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Заменитель stcmd для st2git_bench.py: отвечает на list -cf, hist и co так же, как настоящий
+# stcmd, но по синтетическому виду, описанному в JSON-файле из переменной окружения FAKE_STCMD_VIEW.
+# Вид строится детерминированно из параметров (seed, число папок, файлов, ревизий, размер файлов),
+# поэтому хранить его содержимое не нужно.
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ENCODING = 'windows-1251'
+AUTHORS = ['Иванов Иван', 'Петров Петр', 'Sidorov Sidor', 'Кузнецова Анна', 'Smith John']
+COMMENTS = ['', 'Исправлена ошибка', 'Fixed build', 'Задача №{}', 'Refactoring {}', 'Новая форма отчета']
+BASE_DATE = datetime(2015, 1, 1, 9, 0, 0)
+
+
+# -------------------------------------------------------------------------------------------------
+def default_view():
+    return {'seed': 1, 'folders': 10, 'width': 3, 'files': 10, 'revisions': 5, 'size': 4096,
+            'deleted': 0.02, 'renamed': 0.05, 'unchanged': 0.05, 'latency': 0.0, 'label': 'BENCH_LABEL'}
+
+
+# -------------------------------------------------------------------------------------------------
+def folder_paths(view):
+    """Пути всех папок вида (без корня), дерево шириной view['width']"""
+    paths = ['']
+    for index in range(1, view['folders'] + 1):
+        parent = paths[(index - 1) // max(1, view['width'])]
+        paths.append('{}Папка_{}/'.format(parent, index))
+    return paths[1:]
+
+
+# -------------------------------------------------------------------------------------------------
+def subfolders(view, st_path):
+    depth = st_path.count('/')
+    return sorted(path[len(st_path):-1] for path in folder_paths(view)
+                  if path.startswith(st_path) and path.count('/') == depth + 1)
+
+
+# -------------------------------------------------------------------------------------------------
+def folder_files(view, st_path):
+    """Файлы папки: список словарей name, deleted, revisions (по возрастанию номера)"""
+    if st_path and st_path not in folder_paths(view):
+        return []
+    files = []
+    for index in range(view['files']):
+        rng = random.Random('{}|{}|{}'.format(view['seed'], st_path, index))
+        name = 'файл_{}.txt'.format(index) if index % 3 == 0 else 'file_{}.cs'.format(index)
+        count = rng.randint(1, max(1, 2 * view['revisions'] - 1))
+        renamed_before = rng.randint(2, count) if count > 1 and rng.random() < view['renamed'] else 0
+        date = BASE_DATE + timedelta(minutes=rng.randint(0, 60 * 24 * 30))
+        revisions = []
+        content_revision = 1
+        size = 0
+        for revision in range(1, count + 1):
+            date += timedelta(minutes=rng.randint(1, 60 * 24 * 7))
+            if revision == 1 or rng.random() >= view['unchanged']:
+                content_revision = revision  # иначе ревизия только меняет свойства, содержимое и размер те же
+                size = max(0, int(view['size'] * rng.uniform(0.5, 1.5)))
+            comment = rng.choice(COMMENTS)
+            revisions.append({'revision': revision,
+                              'author': rng.choice(AUTHORS),
+                              'date': date.strftime('%d.%m.%y %H:%M:%S') + ' MSK',
+                              'comment': comment.format(rng.randint(1, 9999)) if '{}' in comment else comment,
+                              'name': 'old_' + name if revision < renamed_before else name,
+                              'content': content_revision,
+                              'size': size})
+        deleted = rng.random() < view['deleted']
+        if view.get('until'):
+            # Вид на момент until: более поздних ревизий еще нет (для проверки --sync)
+            revisions = [revision for revision in revisions
+                         if datetime.strptime(revision['date'][:17], '%d.%m.%y %H:%M:%S') <= until(view)]
+            if not revisions:
+                continue
+        files.append({'name': name, 'deleted': deleted, 'revisions': revisions})
+    return files
+
+
+# -------------------------------------------------------------------------------------------------
+def until(view):
+    return datetime.strptime(view['until'], '%Y-%m-%d %H:%M:%S')
+
+
+# -------------------------------------------------------------------------------------------------
+def content(view, st_path, file_name, revision):
+    seed = hashlib.sha1('{}|{}|{}|{}'.format(view['seed'], st_path, file_name, revision['content']).encode()).digest()
+    block = (seed.hex() + '\r\n').encode() * 64
+    size = revision['size']
+    return (block * (size // len(block) + 1))[:size]
+
+
+# -------------------------------------------------------------------------------------------------
+def view_totals(view):
+    """Сколько всего файлов и ревизий, и сколько файлов должно оказаться на метке"""
+    totals = {'folders': view['folders'], 'files': 0, 'revisions': 0, 'label_files': 0}
+    for st_path in folder_paths(view):
+        for file_item in folder_files(view, st_path):
+            totals['files'] += 1
+            totals['revisions'] += len(file_item['revisions'])
+            if not file_item['deleted']:
+                totals['label_files'] += 1
+    return totals
+
+
+# -------------------------------------------------------------------------------------------------
+def parse_args(argv):
+    command = argv[0]
+    options = {}
+    positional = []
+    with_value = {'-p', '-fp', '-cfgl', '-cfgd', '-cfgp', '-vn', '-vl', '-vd'}
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg in with_value:
+            options[arg] = argv[i + 1]
+            i += 2
+        else:
+            if arg.startswith('-'):
+                options[arg] = True
+            else:
+                positional.append(arg)
+            i += 1
+    return command, options, positional
+
+
+# -------------------------------------------------------------------------------------------------
+def st_path_from_connection(connection):
+    # user:password@server:port/project/view/path
+    parts = connection.split('/', 3)
+    return parts[3] if len(parts) > 3 else ''
+
+
+# -------------------------------------------------------------------------------------------------
+def folder_output(view, command, st_path, names=()):
+    out = ['Folder: {} (working dir: C:\\{})'.format(st_path.rstrip('/').rsplit('/', 1)[-1] or 'Root',
+                                                     st_path.replace('/', '\\').rstrip('\\'))]
+    if command == 'list':
+        for folder in subfolders(view, st_path):
+            out.append('    {}\\'.format(folder))
+        for file_item in folder_files(view, st_path):
+            if not file_item['deleted']:
+                last = file_item['revisions'][-1]
+                out.append('Current       rw   {:>8} {} {}'.format(last['size'], last['date'][:17], file_item['name']))
+    else:
+        for file_item in folder_files(view, st_path):
+            if names and file_item['name'] not in names:
+                continue
+            out.append('History for: {}'.format(file_item['name']))
+            out.append('Description: ')
+            out.append('Locked By:')
+            for revision in reversed(file_item['revisions']):
+                out.append('----------------------------')
+                out.append('Revision: {} View: {} Branch Revision: 1.{}'.format(
+                    revision['revision'], view['label'], revision['revision'] - 1))
+                out.append('Author: {} Date: {}'.format(revision['author'], revision['date']))
+                if revision['comment']:
+                    out.append(revision['comment'])
+            out.append('=============================================================================')
+    return out
+
+
+# -------------------------------------------------------------------------------------------------
+def main(argv):
+    with open(os.environ['FAKE_STCMD_VIEW'], encoding='utf-8') as f:
+        view = dict(default_view(), **json.load(f))
+    if view['latency'] > 0:
+        time.sleep(view['latency'])  # запуск процесса и вход на сервер
+    command, options, positional = parse_args(argv)
+    st_path = st_path_from_connection(options.get('-p', ''))
+    out = []
+    if command in ('list', 'hist'):
+        # С -is выводится вся папка с подпапками, каждая со своим заголовком
+        st_paths = [st_path] + ([path for path in sorted(folder_paths(view)) if path.startswith(st_path)
+                                 and path != st_path] if '-is' in options else [])
+        for path in st_paths:
+            out.extend(folder_output(view, command, path, positional))
+    elif command == 'co':
+        # Без имен файлов выгружается вся папка, с -is - и все подпапки в одноименные каталоги внутри -fp
+        st_paths = [st_path]
+        if not positional and '-is' in options:
+            st_paths += [path for path in sorted(folder_paths(view)) if path.startswith(st_path) and path != st_path]
+        for path in st_paths:
+            target = os.path.join(options['-fp'], *path[len(st_path):].split('/'))
+            files = {file_item['name']: file_item for file_item in folder_files(view, path)}
+            for name in positional or sorted(files.keys()):
+                file_item = files.get(name)
+                if not file_item or file_item['deleted']:
+                    continue  # файл удален из StarTeam - ничего не выгружается
+                if '-vn' in options:
+                    revisions = [r for r in file_item['revisions'] if r['revision'] == int(options['-vn'])]
+                else:
+                    revisions = file_item['revisions'][-1:]  # состояние на метке
+                for revision in revisions:
+                    os.makedirs(target, exist_ok=True)
+                    data = content(view, path, name, revision)
+                    target_file = os.path.join(target, revision['name'])
+                    if '-o' not in options and os.path.isfile(target_file):
+                        # Без -o файл в статусе Current не выгружается повторно
+                        with open(target_file, mode='rb') as f:
+                            if f.read() == data:
+                                continue
+                    with open(target_file, mode='wb') as f:
+                        f.write(data)
+    else:
+        sys.stderr.write('An invalid argument was encountered: {}'.format(command))
+        return 1
+    if out:
+        sys.stdout.buffer.write(('\r\n'.join(out) + '\r\n').encode(ENCODING, errors='replace'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
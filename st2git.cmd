@@ -1,2 +1,2 @@
-python st2git.py
+python st2git.py %*
 pause
\ No newline at end of file
@@ -1,47 +1,63 @@
 import sys
+import argparse
+import collections
 import concurrent.futures
+import io
+import itertools
+import atexit
+import contextlib
 import configparser
 import fnmatch
+import glob
+import hashlib
+import heapq
 import os
+import queue
+import random
+import re
 import signal
 import shutil
+import sqlite3
 import subprocess
 import threading
 import time
 import uuid
+import json
+import zlib
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 
 try:
-    from git import Repo, Actor
+    from git import Repo, Actor, Blob
+    from git.index.typ import BaseIndexEntry
+    from gitdb.base import IStream
 except:
     print('Error: GitPython library required (install with "pip install gitpython")')
     quit(-1)
 
 # -------------------------------------------------------------------------------------------------
 python_version = sys.version.split(' ', 1)[0]
-if python_version < '3.6':
+if sys.version_info < (3, 6):
     print('Error: Version of python interpreter should start from 3.6 ({})'.format(python_version))
     quit(-1)
 
 # -------------------------------------------------------------------------------------------------
 COMMAND_LIST = 'list'
 COMMAND_HIST = 'hist'
-KEY_FILENAME = 'filename'
-KEY_REVISION = 'revision'
-KEY_PATH = 'path'
-KEY_AUTHOR = 'author'
-KEY_COMMENT = 'comment'
-KEY_DATE = 'date'
+LISTING_FILES = 'files'  # файлы папки из вывода stcmd list (в журнале и кэше ответов)
+HistoryItem = collections.namedtuple('HistoryItem', 'path filename revision author date comment')
+ListedFile = collections.namedtuple('ListedFile', 'size date')
+GIT_BACKEND_GITPYTHON = 'gitpython'
+GIT_BACKEND_FAST_IMPORT = 'fast-import'
+GIT_BRANCH = 'master'
 
 PATH_ROOT = os.path.abspath('')
 PATH_GIT_REPO = os.path.join(PATH_ROOT, '_REPO')
-PATH_TEMP = os.path.join(PATH_ROOT, '_TEMP')
-LOCK = threading.RLock()
+# Сколько потоков одновременно пишут в git (во всех репозиториях процесса, см. --jobs)
+GIT_WRITERS = threading.BoundedSemaphore(1)
 EPOCH = datetime.utcfromtimestamp(0)
-EXECUTOR = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='thread')
 ERROR_MESSAGES = ['Some of the required resources are currently in use by other users',
                   'An existing connection was forcibly closed by the remote host',
                   'Unable to update file status information in the database on the local workstation',
@@ -51,32 +67,264 @@ ERROR_MESSAGES = ['Some of the required resources are currently in use by other
                   'Memory allocation failed',
                   'An invalid argument was encountered',
                   'Access violation']
+# Ошибки, по которым видно, что сервер StarTeam перегружен - уменьшаем число одновременных stcmd
+CONGESTION_MESSAGES = ['Some of the required resources are currently in use by other users',
+                       'An existing connection was forcibly closed by the remote host',
+                       'Read timed out', 'Connection reset',
+                       'Failed to login to Active Directory server',
+                       'Memory allocation failed']
+RETRY_STATE = threading.local()
+# Заголовок папки в выводе stcmd list/hist
+FOLDER_HEADER = re.compile(r'^Folder: .*\(working dir: (.*)\)\s*$')
+# Строка файла в выводе stcmd list -cf: статус, права, размер, [время изменения], имя
+LIST_FILE = re.compile(r'^\s*\S+\s+\S+\s+(\d+)\s+(?:(\d\d\.\d\d\.\d\d \d\d:\d\d:\d\d)\s+)?(.+?)\s*$')
+LOG_DEBUG = 'DEBUG'
+LOG_INFO = 'INFO'
+LOG_WARNING = 'WARNING'
+LOG_ERROR = 'ERROR'
+LOG_CRITICAL = 'CRITICAL'
+LOG_LEVELS = [LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR, LOG_CRITICAL]
 
 
 def filename(ext):
     return '{}.{}'.format(os.path.splitext(__file__)[0], ext)
 
 
+def shard_name(path, shard):
+    # st2git.log -> st2git.shard2.log, _REPO -> _REPO.shard2
+    if not shard or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.shard{}{}'.format(root, shard[0], ext)
+
+
 #
 def kill_app(message):
     # Инным способом остановить все потоки не получается
-    log('KILLIG APP {}'.format(message))
+    log('KILLIG APP {}'.format(message), level=LOG_CRITICAL)
+    LOGGER.flush()
     os.kill(os.getpid(), signal.SIGTERM)
 
 
 # -------------------------------------------------------------------------------------------------
-def log(message_text, indent=False):
-    LOCK.acquire(True)
-    try:
-        message_text = '[{}][{}_{}] {}'.format(current_time_str(), threading.get_ident(), threading.current_thread().name, str(message_text))
-        if indent:
-            message_text = '\n' + message_text
-        log_file_name = os.path.join(PATH_ROOT, filename('log'))
-        with open(log_file_name, mode='a') as f:
-            print(message_text)
-            f.writelines('\n' + message_text)
-    finally:
-        LOCK.release()
+class AsyncLogger:
+    """Журнал пишется из отдельного потока: сообщения копятся в очереди и записываются пачками,
+    рабочие потоки на записи в файл не ждут. Файл журнала переименовывается по достижении max_size"""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.level = LOG_LEVELS.index(LOG_INFO)
+        self.json_format = False
+        self.max_size = 0
+        self.backups = 5
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def configure(self, level, json_format, max_size, backups):
+        self.level = LOG_LEVELS.index(level)
+        self.json_format = json_format
+        self.max_size = max_size
+        self.backups = backups
+
+    def put(self, level, message_text, indent):
+        if LOG_LEVELS.index(level) < self.level:
+            return
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.worker, name='logger', daemon=True)
+                    self.thread.start()
+        thread = threading.current_thread()
+        self.queue.put((time.time(), threading.get_ident(), thread.name, level, str(message_text), indent))
+
+    def format(self, record):
+        timestamp, ident, thread_name, level, message_text, indent = record
+        time_str = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        if self.json_format:
+            return json.dumps({'time': time_str, 'level': level, 'thread': '{}_{}'.format(ident, thread_name),
+                               'message': message_text}, ensure_ascii=False)
+        message_text = '[{}][{}_{}] {}{}'.format(time_str, ident, thread_name,
+                                                 '' if level == LOG_INFO else level + ': ', message_text)
+        return '\n' + message_text if indent else message_text
+
+    def rotate(self, f):
+        f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.file_name, i)):
+                os.replace('{}.{}'.format(self.file_name, i), '{}.{}'.format(self.file_name, i + 1))
+        if self.backups > 0:
+            os.replace(self.file_name, self.file_name + '.1')
+        else:
+            os.remove(self.file_name)
+        return open(self.file_name, mode='a', encoding='utf-8')
+
+    def worker(self):
+        with open(self.file_name, mode='a', encoding='utf-8') as f:
+            while True:
+                records = [self.queue.get()]
+                while len(records) < 1000:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                events = [record for record in records if isinstance(record, threading.Event)]
+                text = ''.join(self.format(record) + '\n' for record in records
+                               if not isinstance(record, threading.Event))
+                if text:
+                    try:
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
+                    except UnicodeEncodeError:
+                        sys.stdout.write(text.encode(sys.stdout.encoding or 'ascii', 'replace').decode(
+                            sys.stdout.encoding or 'ascii'))
+                    f.write(text)
+                    f.flush()
+                    if self.max_size > 0 and f.tell() > self.max_size:
+                        f = self.rotate(f)
+                for event in events:
+                    event.set()
+
+    def flush(self, timeout=10):
+        # Дожидаемся, пока записано все, что было в очереди до вызова
+        if self.thread is not None:
+            event = threading.Event()
+            self.queue.put(event)
+            event.wait(timeout)
+
+
+LOGGER = AsyncLogger(os.path.join(PATH_ROOT, filename('log')))
+atexit.register(LOGGER.flush)
+
+
+# -------------------------------------------------------------------------------------------------
+class Metrics:
+    """Счетчики и гистограммы длительности по этапам (stcmd list/hist/co, git add/commit,
+    ожидание блокировок, паузы перед повтором) и по папкам StarTeam"""
+    BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, float('inf')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}  # этап -> [число, сумма секунд, максимум, счетчики по BUCKETS]
+        self.folders = collections.Counter()  # папка -> сумма секунд
+        self.counters = collections.Counter()
+        self.started = time.time()
+        self.file_name = None
+        self.interval = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def observe(self, phase, seconds, folder=None):
+        with self.lock:
+            stat = self.phases.get(phase)
+            if stat is None:
+                stat = self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stat[3][i] += 1
+                    break
+            if folder is not None:
+                self.folders[folder] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, phase, folder=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start, folder)
+
+    def percentile(self, stat, fraction):
+        # Верхняя граница корзины, в которую попадает нужная доля наблюдений
+        rank = stat[0] * fraction
+        total = 0
+        for i, bound in enumerate(self.BUCKETS):
+            total += stat[3][i]
+            if total >= rank:
+                return min(bound, stat[2])
+        return stat[2]
+
+    def snapshot(self):
+        with self.lock:
+            return {'uptime': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'phases': {phase: {'count': stat[0], 'sum': stat[1], 'max': stat[2],
+                                       'p50': self.percentile(stat, 0.5), 'p95': self.percentile(stat, 0.95),
+                                       'buckets': dict(zip([str(bound) for bound in self.BUCKETS], stat[3]))}
+                               for phase, stat in self.phases.items()},
+                    'slowest_folders': self.folders.most_common(20)}
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('st2git_{}_total {}'.format(name, value))
+            for phase, stat in sorted(self.phases.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, stat[3]):
+                    cumulative += bucket
+                    lines.append('st2git_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                        phase, '+Inf' if bound == float('inf') else bound, cumulative))
+                lines.append('st2git_phase_seconds_sum{{phase="{}"}} {:.3f}'.format(phase, stat[1]))
+                lines.append('st2git_phase_seconds_count{{phase="{}"}} {}'.format(phase, stat[0]))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        if not self.file_name:
+            return
+        try:
+            text = self.prometheus() if self.file_name.endswith('.prom') else \
+                json.dumps(self.snapshot(), ensure_ascii=False, indent=1)
+            # Пишем во временный файл и переименовываем, чтобы читатель не увидел половину файла
+            with open(self.file_name + '.tmp', mode='w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(self.file_name + '.tmp', self.file_name)
+        except BaseException as e:
+            log('ERROR when writing metrics to "{}" ({})'.format(self.file_name, e), level=LOG_ERROR)
+
+    def start(self, file_name, interval):
+        self.file_name = file_name
+        self.interval = interval
+        if file_name and interval > 0:
+            self.thread = threading.Thread(target=self.worker, name='metrics', daemon=True)
+            self.thread.start()
+
+    def worker(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self.stop_event.set()
+        self.export()
+
+    def report(self):
+        snapshot = self.snapshot()
+        lines = ['RUN REPORT ({:.0f} sec):'.format(snapshot['uptime'])]
+        for phase, stat in sorted(snapshot['phases'].items(), key=lambda pair: -pair[1]['sum']):
+            lines.append('\t{:<24} count={:<8} total={:>10.1f}s avg={:>8.3f}s p50<={:<8.3g} p95<={:<8.3g} max={:.1f}s'.format(
+                phase, stat['count'], stat['sum'], stat['sum'] / stat['count'] if stat['count'] else 0,
+                stat['p50'], stat['p95'], stat['max']))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('\t{:<24} {}'.format(name, value))
+        if snapshot['slowest_folders']:
+            lines.append('\tSlowest folders:')
+            for folder, seconds in snapshot['slowest_folders'][:10]:
+                lines.append('\t\t{:>10.1f}s {}'.format(seconds, folder))
+        log('\n'.join(lines))
+
+
+METRICS = Metrics()
+
+
+# -------------------------------------------------------------------------------------------------
+def log(message_text, indent=False, level=LOG_INFO):
+    LOGGER.put(level, message_text, indent)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -151,6 +399,25 @@ def st_time_to_utc(str_st_time):
     return dt_utc.isoformat()
 
 
+# -------------------------------------------------------------------------------------------------
+def st_time_to_timestamp(str_st_time):
+    str_st_time = str_st_time.rsplit(' ', 1)[0]  # отрезал MSK/MSD на конце
+    dt_local = datetime.strptime(str_st_time, '%d.%m.%y %H:%M:%S')
+    return int(dt_local.timestamp())
+
+
+# -------------------------------------------------------------------------------------------------
+def st_connection_string(settings, st_path):
+    return '{}:{}@{}:{}/{}/{}/{}'.format(
+        settings.starteam_login,
+        settings.starteam_password,
+        settings.starteam_server,
+        settings.starteam_port,
+        settings.starteam_project,
+        settings.starteam_view,
+        st_path)
+
+
 # -------------------------------------------------------------------------------------------------
 def need_retry(err_str):
     return sum([err_str.count(msg) for msg in ERROR_MESSAGES])
@@ -162,7 +429,7 @@ def make_dir(path):
         if not os.path.exists(path):
             os.makedirs(path)
     except BaseException as e:
-        log('ERROR: can''t create directory "{}" ({})'.format(path, e))
+        log('ERROR: can''t create directory "{}" ({})'.format(path, e), level=LOG_ERROR)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -196,22 +463,125 @@ def clean(path, masks=None, write_log=True):
         except FileNotFoundError:
             pass  # если папка отсутствует, то продолжаем молча
         except BaseException as e:
-            log('ERROR when cleaning path="{}" ({})'.format(path, e))
+            log('ERROR when cleaning path="{}" ({})'.format(path, e), level=LOG_ERROR)
             return False
     return True
 
 
+# -------------------------------------------------------------------------------------------------
+def is_congestion(err_str):
+    return sum([err_str.count(msg) for msg in CONGESTION_MESSAGES])
+
+
 # -------------------------------------------------------------------------------------------------
 def retry(err_str, func, *args):
-    log('------------ NEED RETRY ({}). Waiting for 30 sec.'.format(err_str))
-    time.sleep(30)
-    log('-------------RETRYING NOW.')
-    return func(*args)
+    # Повторы вложенные (func сама вызывает retry при ошибке), номер попытки храним для потока
+    attempt = getattr(RETRY_STATE, 'attempt', 0) + 1
+    if attempt > STCMD_LIMITER.retry_limit:
+        kill_app('Too many retries ({}): {}'.format(attempt - 1, err_str))
+    if is_congestion(err_str):
+        STCMD_LIMITER.on_congestion()
+    # Экспоненциальная задержка со случайным разбросом, чтобы потоки не повторяли одновременно
+    delay = min(STCMD_LIMITER.retry_max_delay, STCMD_LIMITER.retry_delay * 2 ** (attempt - 1))
+    delay = random.uniform(delay / 2, delay)
+    log('------------ NEED RETRY #{} ({}). Waiting for {:.1f} sec.'.format(attempt, err_str, delay), level=LOG_WARNING)
+    METRICS.count('retries')
+    with METRICS.timer('retry_sleep'):
+        time.sleep(delay)
+    log('-------------RETRYING NOW.', level=LOG_WARNING)
+    RETRY_STATE.attempt = attempt
+    try:
+        return func(*args)
+    finally:
+        RETRY_STATE.attempt = attempt - 1
+
+
+# -------------------------------------------------------------------------------------------------
+class AdaptiveLimiter:
+    """Ограничивает число одновременных процессов stcmd (AIMD): после limit удачных вызовов
+    подряд предел растет на 1, при признаках перегрузки сервера уменьшается вдвое.
+    Освободившееся место достается проекту, у которого сейчас меньше всего запущенных stcmd (--jobs)"""
+    def __init__(self, initial=8, minimum=1, maximum=16):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.jobs = collections.Counter()  # проект -> запущено stcmd
+        self.waiting = collections.Counter()  # проект -> ждут места
+        self.successes = 0
+        self.last_decrease = 0
+        self.limit = self.minimum = self.maximum = 0
+        self.retry_limit = 10
+        self.retry_delay = 5
+        self.retry_max_delay = 300
+        self.configure(initial, minimum, maximum)
+
+    def configure(self, initial, minimum, maximum, retry_limit=None, retry_delay=None, retry_max_delay=None):
+        with self.condition:
+            self.minimum = max(1, minimum)
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.maximum, max(self.minimum, initial))
+            self.retry_limit = self.retry_limit if retry_limit is None else retry_limit
+            self.retry_delay = self.retry_delay if retry_delay is None else retry_delay
+            self.retry_max_delay = self.retry_max_delay if retry_max_delay is None else retry_max_delay
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, job=''):
+        start = time.time()
+        with self.condition:
+            self.waiting[job] += 1
+            while self.active >= self.limit or self.jobs[job] > min(self.jobs[other] for other in self.waiting):
+                self.condition.wait()
+            self.waiting[job] -= 1
+            if self.waiting[job] <= 0:
+                del self.waiting[job]
+            self.active += 1
+            self.jobs[job] += 1
+            self.condition.notify_all()  # теперь первым может оказаться другой проект
+        METRICS.observe('stcmd_slot_wait', time.time() - start)
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.jobs[job] -= 1
+                self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def on_congestion(self):
+        with self.condition:
+            # Одна волна ошибок от одновременно работавших процессов - одно уменьшение
+            if time.time() - self.last_decrease < self.retry_delay:
+                return
+            self.last_decrease = time.time()
+            self.successes = 0
+            new_limit = max(self.minimum, self.limit // 2)
+            if new_limit != self.limit:
+                log('StarTeam server is overloaded, stcmd concurrency {} -> {}'.format(self.limit, new_limit),
+                    level=LOG_WARNING)
+                self.limit = new_limit
+
+
+STCMD_LIMITER = AdaptiveLimiter()
 
 
 # -------------------------------------------------------------------------------------------------
 class GlobalSettings:
-    def __init__(self):
+    def __init__(self, ini_filename=None, root=None, job_name=''):
+        # Файлы проекта (журналы, кэши, отчеты) лежат рядом с его ini, каталоги _REPO, _TEMP и т.д. - в root
+        self.ini_filename = ini_filename or filename('ini')
+        self.root = root or PATH_ROOT
+        self.job_name = job_name  # имя проекта при переносе нескольких проектов (--jobs)
+        self.repo_path = os.path.join(self.root, '_REPO')
+        self.temp_path = os.path.join(self.root, '_TEMP')
+        self.verify_path = os.path.join(self.root, '_VERIFY')
+        self.progress = Metrics()  # найдено и закоммичено ревизий проекта
         self.stcmd = ''
         self.starteam_server = ''
         self.starteam_port = ''
@@ -221,15 +591,82 @@ class GlobalSettings:
         self.starteam_password = ''
         self.view_label = ''
         self.git_url = ''
+        self.excluded_folders = ['BLL', 'BLL_Client', 'Doc', '_Personal', 'DBOReports', 'BUILD', 'Scripts',
+                                 '_TZ', '_ProjectData', '_ProjectData2', 'Config', 'DLL']
+        # '###MBC41', 'SETUP', 'BASE', 'RT_Tpl', 'WWW', 'RTF',  'XSD', 'History',
+        # 'WWW_react', '### Native ReactUI', 'EXTERNAL', 'MIG_UTIL', #'BLS'
+        self.checkout_batch_size = 100
+        self.git_backend = GIT_BACKEND_GITPYTHON
+        self.fast_import_checkpoint = 1000
+        self.list_concurrency = 4
+        self.blob_cache_path = os.path.join(self.root, '_CACHE')
+        self.blob_cache_size = 0
+        self.changeset_window = 0
+        self.stcmd_concurrency = 8
+        self.stcmd_min_concurrency = 1
+        self.stcmd_max_concurrency = 16
+        self.retry_limit = 10
+        self.retry_delay = 5
+        self.retry_max_delay = 300
+        self.log_level = LOG_INFO
+        self.log_format = 'text'
+        self.log_max_size = 100 * 1024 * 1024
+        self.log_backups = 5
+        self.scratch_quota = 0
+        self.direct_import = False
+        self.metrics_file = ''
+        self.metrics_interval = 60
+        self.stcmd_tree_depth = 0
+        self.download_workers = 8
+        self.pipeline_queue = 16
+        self.response_cache_path = self.file_name('responses.db')
+        self.response_cache_ttl = 0
+        self.schedule_window = 1000
+        self.schedule_split = 0
+        self.plan_samples = 0
+        self.plan_commit_cost = 0.05
+        self.lfs_extensions = []
+        self.lfs_threshold = 0
+        self.lfs_store_path = ''
+        self.repack_interval = 0
+        self.final_repack = False
+        self.push_interval = 0
+        self.push_minutes = 0
+        self.views = []  # (вид, метка, ветка git), первый - StarteamView и ViewLabel в master
+        self.sync_time = ''  # --sync: состояние вида на это время вместо метки
+        self.shard = None
+        self.pipeline = None
+        self.journal = None
+        self.blob_cache = None
+        self.response_cache = None
+        self.scratch = None
+        self.listed_files = {}  # папка -> {файл: ListedFile} из stcmd list
+        self.lfs = None
+        self.maintenance = None
+        self.pusher = None
 
         self.__success = False
         self.read_config()
+        self.broker = StarteamBroker(self)
 
     def was_success(self):
         return self.__success
 
+    def file_name(self, ext):
+        return '{}.{}'.format(os.path.splitext(self.ini_filename)[0], ext)
+
+    def thread_name(self, name):
+        return '{}_{}'.format(self.job_name, name) if self.job_name else name
+
+    def full_path(self, path):
+        return path if not path or os.path.isabs(path) else os.path.join(self.root, path)
+
+    def configuration(self):
+        # Параметры stcmd, задающие состояние вида: метка или, при синхронизации, время
+        return ['-cfgd', self.sync_time] if self.sync_time else ['-cfgl', self.view_label]
+
     def read_config(self):
-        ini_filename = filename('ini')
+        ini_filename = self.ini_filename
         section_special = 'SPECIAL'
         section_common = 'COMMON'
         try:
@@ -247,6 +684,83 @@ class GlobalSettings:
             self.starteam_login = parser.get(section_special, 'StarteamLogin').strip()
             self.view_label = parser.get(section_special, 'ViewLabel').strip()
             self.git_url = parser.get(section_special, 'Git').strip()
+            self.views = [(self.starteam_view, self.view_label, GIT_BRANCH)]
+            for line in parser.get(section_special, 'Branches', fallback='').splitlines():
+                if not line.strip():
+                    continue
+                branch, _, view_label = line.partition('=')
+                view, _, label = view_label.rpartition(':')
+                if not branch.strip() or not view.strip() or not label.strip():
+                    raise ValueError('Branches: expected "branch = view : label", got "{}"'.format(line.strip()))
+                if branch.strip() in [view_branch for _, _, view_branch in self.views]:
+                    raise ValueError('Branches: duplicate branch "{}"'.format(branch.strip()))
+                self.views.append((view.strip(), label.strip(), branch.strip()))
+            if parser.has_option(section_special, 'ExcludedFolders'):
+                self.excluded_folders = [folder.strip() for folder in
+                                         parser.get(section_special, 'ExcludedFolders').split(',') if folder.strip()]
+            self.checkout_batch_size = parser.getint(section_common, 'CheckoutBatchSize',
+                                                     fallback=self.checkout_batch_size)
+            self.git_backend = parser.get(section_common, 'GitBackend', fallback=self.git_backend).strip().lower()
+            self.fast_import_checkpoint = parser.getint(section_common, 'FastImportCheckpoint',
+                                                        fallback=self.fast_import_checkpoint)
+            self.list_concurrency = max(1, parser.getint(section_common, 'ListConcurrency',
+                                                         fallback=self.list_concurrency))
+            self.blob_cache_path = self.full_path(parser.get(section_common, 'BlobCache', fallback='').strip()) or \
+                self.blob_cache_path
+            self.blob_cache_size = parser.getint(section_common, 'BlobCacheSize',
+                                                 fallback=self.blob_cache_size) * 1024 * 1024
+            self.changeset_window = parser.getint(section_common, 'ChangesetWindow', fallback=self.changeset_window)
+            self.stcmd_concurrency = parser.getint(section_common, 'StcmdConcurrency',
+                                                   fallback=self.stcmd_concurrency)
+            self.stcmd_min_concurrency = parser.getint(section_common, 'StcmdMinConcurrency',
+                                                       fallback=self.stcmd_min_concurrency)
+            self.stcmd_max_concurrency = parser.getint(section_common, 'StcmdMaxConcurrency',
+                                                       fallback=self.stcmd_max_concurrency)
+            self.retry_limit = parser.getint(section_common, 'RetryLimit', fallback=self.retry_limit)
+            self.retry_delay = parser.getint(section_common, 'RetryDelay', fallback=self.retry_delay)
+            self.retry_max_delay = parser.getint(section_common, 'RetryMaxDelay', fallback=self.retry_max_delay)
+            self.log_level = parser.get(section_common, 'LogLevel', fallback=self.log_level).strip().upper()
+            self.log_format = parser.get(section_common, 'LogFormat', fallback=self.log_format).strip().lower()
+            self.log_max_size = parser.getint(section_common, 'LogMaxSize',
+                                              fallback=self.log_max_size // (1024 * 1024)) * 1024 * 1024
+            self.log_backups = parser.getint(section_common, 'LogBackups', fallback=self.log_backups)
+
+            if self.log_level not in LOG_LEVELS:
+                raise ValueError('UNKNOWN LogLevel "{}" in {}'.format(self.log_level, ini_filename))
+            if self.log_format not in ('text', 'json'):
+                raise ValueError('UNKNOWN LogFormat "{}" in {}'.format(self.log_format, ini_filename))
+            if not self.job_name:
+                # При --jobs лог общий для всех проектов, его настраивает файл заданий
+                LOGGER.configure(self.log_level, self.log_format == 'json', self.log_max_size, self.log_backups)
+            self.scratch_quota = parser.getint(section_common, 'ScratchQuota', fallback=self.scratch_quota) * 1024 * 1024
+            self.direct_import = parser.getboolean(section_common, 'DirectImport', fallback=self.direct_import)
+            self.metrics_file = parser.get(section_common, 'MetricsFile', fallback=self.metrics_file).strip()
+            self.metrics_file = self.full_path(self.metrics_file)
+            self.metrics_interval = parser.getint(section_common, 'MetricsInterval', fallback=self.metrics_interval)
+            self.stcmd_tree_depth = parser.getint(section_common, 'StcmdTreeDepth', fallback=self.stcmd_tree_depth)
+            self.download_workers = parser.getint(section_common, 'DownloadWorkers', fallback=self.download_workers)
+            self.pipeline_queue = parser.getint(section_common, 'PipelineQueue', fallback=self.pipeline_queue)
+            self.schedule_window = parser.getint(section_common, 'ScheduleWindow', fallback=self.schedule_window)
+            self.schedule_split = parser.getint(section_common, 'ScheduleSplit', fallback=self.schedule_split)
+            self.response_cache_path = self.full_path(parser.get(section_common, 'ResponseCache',
+                                                                 fallback='').strip()) or self.response_cache_path
+            self.response_cache_ttl = parser.getint(section_common, 'ResponseCacheTTL',
+                                                    fallback=self.response_cache_ttl) * 3600
+            self.plan_samples = parser.getint(section_common, 'PlanSamples', fallback=self.plan_samples)
+            self.plan_commit_cost = parser.getfloat(section_common, 'PlanCommitCost', fallback=self.plan_commit_cost)
+            self.lfs_extensions = [extension.strip().lstrip('*.') for extension in
+                                   parser.get(section_common, 'LfsExtensions', fallback='').split(',')
+                                   if extension.strip().lstrip('*.')]
+            self.lfs_threshold = parser.getint(section_common, 'LfsThreshold', fallback=self.lfs_threshold) * 1024
+            self.lfs_store_path = self.full_path(parser.get(section_common, 'LfsStore',
+                                                            fallback=self.lfs_store_path).strip())
+            self.repack_interval = parser.getint(section_common, 'RepackInterval', fallback=self.repack_interval)
+            self.final_repack = parser.getboolean(section_common, 'FinalRepack', fallback=self.final_repack)
+            self.push_interval = parser.getint(section_common, 'PushInterval', fallback=self.push_interval)
+            self.push_minutes = parser.getint(section_common, 'PushMinutes', fallback=self.push_minutes)
+
+            if self.git_backend not in (GIT_BACKEND_GITPYTHON, GIT_BACKEND_FAST_IMPORT):
+                raise ValueError('UNKNOWN GitBackend "{}" in {}'.format(self.git_backend, ini_filename))
 
             # проверка Labels -----------------------------------
             if not self.view_label:  # Если не дали совсем никаких меток для загрузки
@@ -258,14 +772,15 @@ class GlobalSettings:
             # проверка stsmd -----------------------------------
             if self.stcmd:  # если пусть к stcmd не задан
                 self.stcmd = os.path.normpath(self.stcmd)
-                self.stcmd = self.stcmd + os.sep + 'stcmd.exe'
+                if not os.path.isfile(self.stcmd):  # задан каталог клиента, а не сам файл (например, fake_stcmd)
+                    self.stcmd = self.stcmd + os.sep + 'stcmd.exe'
                 if not os.path.exists(self.stcmd):
                     raise FileNotFoundError('NOT FOUND ' + self.stcmd)
             else:
                 raise FileNotFoundError('NOT DEFINED path to stcmd')
 
         except BaseException as e:
-            log('ERROR when reading settings from file "{}":\n\t\t{}'.format(ini_filename, e))
+            log('ERROR when reading settings from file "{}":\n\t\t{}'.format(ini_filename, e), level=LOG_ERROR)
 
         else:
             self.__success = True
@@ -274,9 +789,535 @@ class GlobalSettings:
                 'StarteamView = {}\n\t'
                 'Path to stcmd.exe = {}\n\t'
                 'Label = {}\n\t'
-                'Git={}'.
+                'Git={}\n\t'
+                'Branches = {}\n\t'
+                'ExcludedFolders = {}\n\t'
+                'CheckoutBatchSize = {}\n\t'
+                'GitBackend = {}\n\t'
+                'ListConcurrency = {}\n\t'
+                'BlobCache = {} ({} MB)\n\t'
+                'ResponseCache = {} (TTL {} h)\n\t'
+                'ChangesetWindow = {}\n\t'
+                'StcmdConcurrency = {} ({}..{})\n\t'
+                'StcmdTreeDepth = {}\n\t'
+                'DownloadWorkers = {}, PipelineQueue = {}, ScheduleWindow = {}, ScheduleSplit = {}\n\t'
+                'RetryLimit = {}, RetryDelay = {}..{}\n\t'
+                'ScratchQuota = {} MB\n\t'
+                'DirectImport = {}\n\t'
+                'LfsExtensions = {}, LfsThreshold = {} KB\n\t'
+                'RepackInterval = {}, FinalRepack = {}\n\t'
+                'PushInterval = {}, PushMinutes = {}'.
                 format(self.starteam_project, self.starteam_view, self.stcmd,
-                       self.view_label, self.git_url))
+                       self.view_label, self.git_url,
+                       ', '.join('{} = {}:{}'.format(branch, view, label) for view, label, branch in self.views),
+                       ', '.join(self.excluded_folders),
+                       self.checkout_batch_size, self.git_backend,
+                       self.list_concurrency, self.blob_cache_path, self.blob_cache_size // (1024 * 1024),
+                       self.response_cache_path, self.response_cache_ttl // 3600,
+                       self.changeset_window, self.stcmd_concurrency, self.stcmd_min_concurrency,
+                       self.stcmd_max_concurrency, self.stcmd_tree_depth, self.download_workers,
+                       self.pipeline_queue, self.schedule_window, self.schedule_split, self.retry_limit, self.retry_delay, self.retry_max_delay,
+                       self.scratch_quota // (1024 * 1024), self.direct_import,
+                       ', '.join(self.lfs_extensions), self.lfs_threshold // 1024,
+                       self.repack_interval, self.final_repack, self.push_interval, self.push_minutes))
+
+
+# -------------------------------------------------------------------------------------------------
+class SqliteStore:
+    """Общая часть журнала и кэшей: соединение SQLite в режиме WAL, которым пользуются несколько
+    потоков под одной блокировкой, и таблица meta (ключ - значение). TABLES - описания остальных
+    таблиц для CREATE TABLE IF NOT EXISTS"""
+    TABLES = ()
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for table in ('meta (key TEXT PRIMARY KEY, value TEXT)',) + self.TABLES:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS ' + table)
+
+    def get_value(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_value(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# -------------------------------------------------------------------------------------------------
+class Journal(SqliteStore):
+    """Журнал прогресса миграции (SQLite рядом с st2git.ini): какие папки уже получены
+    из StarTeam, какие ревизии уже закоммичены и какие не выгрузились (файл удален из StarTeam).
+    Нужен для продолжения после остановки (--resume) и синхронизации (--sync)"""
+    TABLES = ('listings (path TEXT, command TEXT, result TEXT, PRIMARY KEY (path, command))',
+              'committed (path TEXT, filename TEXT, revision INTEGER, PRIMARY KEY (path, filename, revision))',
+              'absent (path TEXT, filename TEXT, revision INTEGER, PRIMARY KEY (path, filename, revision))',
+              'folders (path TEXT PRIMARY KEY, state TEXT)')
+
+    def check_identity(self, identity):
+        # Продолжать можно только миграцию того же проекта, вида и метки
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+            if row is None:
+                self.connection.execute("INSERT INTO meta (key, value) VALUES ('identity', ?)", (identity,))
+                return True
+            return row[0] == identity
+
+    def get_listing(self, st_path, command):
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM listings WHERE path = ? AND command = ?',
+                                          (st_path, command)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_listing(self, st_path, command, result):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO listings (path, command, result) VALUES (?, ?, ?)',
+                                    (st_path, command, json.dumps(result)))
+
+    def committed_revisions(self, st_path):
+        """Ревизии папки, которые больше не нужно выгружать: закоммиченные и не выгрузившиеся"""
+        with self.lock:
+            rows = self.connection.execute('SELECT filename, revision FROM committed WHERE path = ? UNION '
+                                           'SELECT filename, revision FROM absent WHERE path = ?',
+                                           (st_path, st_path)).fetchall()
+        return set(rows)
+
+    def mark_committed(self, items):
+        """items - список (путь, файл, ревизия)"""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO committed (path, filename, revision) VALUES (?, ?, ?)',
+                                        items)
+
+    def get_folder_state(self, st_path):
+        """Файлы папки из stcmd list на момент последнего успешного переноса: файл -> [размер, время]"""
+        with self.lock:
+            row = self.connection.execute('SELECT state FROM folders WHERE path = ?', (st_path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_folder_states(self, states):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO folders (path, state) VALUES (?, ?)',
+                                        [(st_path, json.dumps(files)) for st_path, files in states.items()])
+
+    def mark_absent(self, items):
+        """items - список (путь, файл, ревизия), которые stcmd co не выгрузил"""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO absent (path, filename, revision) VALUES (?, ?, ?)',
+                                        items)
+
+
+# -------------------------------------------------------------------------------------------------
+class ResponseCache(SqliteStore):
+    """Разобранные ответы stcmd list и hist (сжатый JSON) по серверу, проекту, виду, метке, папке и команде.
+    Состояние вида на метке не меняется, поэтому повторные запуски по той же метке берут списки папок
+    и истории отсюда, а не с сервера. ttl - срок жизни записи в секундах. При ResponseCacheTTL = 0 кэш
+    не открывается вовсе, а с --offline (offline) записи берутся без учета срока"""
+    TABLES = ('responses (key TEXT PRIMARY KEY, created REAL, data BLOB)',)
+
+    def __init__(self, path, ttl, offline=False):
+        self.ttl = ttl
+        self.offline = offline
+        super().__init__(path)
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def response_key(settings, st_path, command):
+        return '{}:{}/{}/{}/{}/{}:{}'.format(settings.starteam_server, settings.starteam_port,
+                                              settings.starteam_project, settings.starteam_view,
+                                              ' '.join(settings.configuration()), st_path, command)
+
+    def get(self, settings, st_path, command):
+        key = self.response_key(settings, st_path, command)
+        with self.lock:
+            row = self.connection.execute('SELECT created, data FROM responses WHERE key = ?', (key,)).fetchone()
+        if row and (self.offline or time.time() - row[0] < self.ttl):
+            self.stats['hits_' + command] += 1
+            return json.loads(zlib.decompress(row[1]).decode('utf-8'))
+        if self.offline:
+            kill_app('Offline: no cached {} for "{}" in response cache'.format(command, st_path))
+        self.stats['misses_' + command] += 1
+        return None
+
+    def set(self, settings, st_path, command, result):
+        if settings.sync_time:
+            return  # состояние на время синхронизации больше не понадобится
+        data = zlib.compress(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, created, data) VALUES (?, ?, ?)',
+                                    (self.response_key(settings, st_path, command), time.time(), data))
+
+    def report(self):
+        log('RESPONSE CACHE: list {} hits / {} misses, hist {} hits / {} misses'.format(
+            self.stats['hits_' + COMMAND_LIST], self.stats['misses_' + COMMAND_LIST],
+            self.stats['hits_' + COMMAND_HIST], self.stats['misses_' + COMMAND_HIST]))
+
+
+# -------------------------------------------------------------------------------------------------
+class BlobCache(SqliteStore):
+    """Кэш выгруженных ревизий по содержимому (git blob id) с вытеснением по размеру.
+    Ревизии, уже выгруженные в прошлых запусках или из других видов, повторно не выгружаются,
+    а ревизии, содержимое которых не изменилось, не коммитятся"""
+    TABLES = ('blobs (hash TEXT PRIMARY KEY, size INTEGER, used REAL)',
+              'revisions (key TEXT PRIMARY KEY, hash TEXT)')
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        make_dir(path)
+        super().__init__(os.path.join(path, 'index.db'))
+        with self.lock:
+            self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        self.pinned = collections.Counter()  # блобы, которые еще предстоит закоммитить, не вытесняем
+        self.last_hash = {}  # путь в репозитории -> последний закоммиченный блоб
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def revision_key(settings, item):
+        # Вид в ключ не входит: одна и та же ревизия файла есть во всех видах проекта
+        return '{}:{}/{}/{}{}@{}/{}'.format(settings.starteam_server, settings.starteam_port,
+                                            settings.starteam_project, item.path, item.filename,
+                                            item.revision, item.date)
+
+    @staticmethod
+    def blob_hash(file_path):
+        sha = hashlib.sha1('blob {}\0'.format(os.path.getsize(file_path)).encode())
+        with open(file_path, mode='rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def blob_path(self, blob):
+        return os.path.join(self.path, blob[:2], blob)
+
+    def lookup(self, key):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT revisions.hash, blobs.size FROM revisions '
+                                          'JOIN blobs ON blobs.hash = revisions.hash WHERE key = ?',
+                                          (key,)).fetchone()
+            if not row or not os.path.exists(self.blob_path(row[0])):
+                return None
+            self.connection.execute('UPDATE blobs SET used = ? WHERE hash = ?', (time.time(), row[0]))
+            self.pinned[row[0]] += 1
+            self.stats['download_hits'] += 1
+            self.stats['download_hit_bytes'] += row[1]
+            return self.blob_path(row[0])
+
+    def store(self, key, temp_file):
+        """Переносит выгруженный файл в кэш, возвращает путь к нему в кэше"""
+        blob = self.blob_hash(temp_file)
+        size = os.path.getsize(temp_file)
+        path = self.blob_path(blob)
+        with self.lock, self.connection:
+            if os.path.exists(path):
+                os.remove(temp_file)
+                self.stats['duplicate_downloads'] += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.move(temp_file, path)
+                self.size += size
+            self.connection.execute('INSERT OR REPLACE INTO blobs (hash, size, used) VALUES (?, ?, ?)',
+                                    (blob, size, time.time()))
+            self.connection.execute('INSERT OR REPLACE INTO revisions (key, hash) VALUES (?, ?)', (key, blob))
+            self.pinned[blob] += 1
+            self.stats['downloads'] += 1
+            self.evict()
+        return path
+
+    def release(self, path):
+        with self.lock:
+            blob = os.path.basename(path)
+            self.pinned[blob] -= 1
+            if self.pinned[blob] <= 0:
+                del self.pinned[blob]
+
+    def is_unchanged(self, repo_path, path):
+        # Ревизии, отличающиеся только метками или свойствами, содержат те же байты
+        blob = os.path.basename(path)
+        unchanged = self.last_hash.get(repo_path) == blob
+        self.last_hash[repo_path] = blob
+        if unchanged:
+            self.stats['skipped_commits'] += 1
+            self.stats['skipped_commit_bytes'] += os.path.getsize(path)
+        return unchanged
+
+    def start_branch(self):
+        # В новой ветке первая ревизия каждого файла коммитится, даже если содержимое уже было в другой
+        with self.lock:
+            self.last_hash.clear()
+
+    def evict(self):
+        if self.max_size <= 0 or self.size <= self.max_size:
+            return
+        for blob, size in self.connection.execute('SELECT hash, size FROM blobs ORDER BY used').fetchall():
+            if self.size <= self.max_size * 0.9:
+                break
+            if blob in self.pinned:
+                continue
+            try:
+                os.remove(self.blob_path(blob))
+            except FileNotFoundError:
+                pass
+            self.connection.execute('DELETE FROM blobs WHERE hash = ?', (blob,))
+            self.connection.execute('DELETE FROM revisions WHERE hash = ?', (blob,))
+            self.size -= size
+            self.stats['evicted'] += 1
+
+    def report(self):
+        log('BLOB CACHE: {} revisions downloaded ({} already cached), {} downloads avoided ({} MB), '
+            '{} unchanged revisions not committed ({} MB), {} blobs evicted, cache size {} MB'.format(
+                self.stats['downloads'], self.stats['duplicate_downloads'],
+                self.stats['download_hits'], self.stats['download_hit_bytes'] // (1024 * 1024),
+                self.stats['skipped_commits'], self.stats['skipped_commit_bytes'] // (1024 * 1024),
+                self.stats['evicted'], self.size // (1024 * 1024)))
+
+
+# -------------------------------------------------------------------------------------------------
+class ScratchArea:
+    """Временный каталог для выгрузки. Выгруженные файлы удаляются сразу после записи в git
+    (или в кэш). Каждый вызов stcmd co заранее занимает ожидаемый объем (размеры из stcmd list)
+    и ждет, пока выгруженное и занятое не поместятся в quota. Если при этом коммитить нечего
+    (committer_idle), без ожидания выгружает самая старая из выгружаемых задач, иначе выгрузки
+    заняли бы все место и ждали друг друга"""
+    def __init__(self, path, quota):
+        self.path = path
+        self.quota = quota
+        self.condition = threading.Condition()
+        self.used = 0
+        self.reserved = 0  # ожидаемый объем выгрузок, которые идут сейчас
+        self.files = {}  # выгруженный файл -> (каталог выгрузки, размер)
+        self.dirs = collections.Counter()  # каталог выгрузки -> число еще не записанных файлов
+        self.tickets = itertools.count()
+        self.tasks = set()  # номера выгружаемых задач
+        self.idle = 0  # коммитящий поток ждет выгрузки
+
+    def new_dir(self):
+        return os.path.join(self.path, str(uuid.uuid4()))
+
+    def has_room(self):
+        with self.condition:
+            return self.quota <= 0 or self.used + self.reserved < self.quota
+
+    @contextlib.contextmanager
+    def task(self):
+        """Выгрузка одной задачи (папки или ее части), возвращает номер задачи для admit"""
+        with self.condition:
+            ticket = next(self.tickets)
+            self.tasks.add(ticket)
+        try:
+            yield ticket
+        finally:
+            with self.condition:
+                self.tasks.discard(ticket)
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def committer_idle(self):
+        with self.condition:
+            self.idle += 1
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.idle -= 1
+
+    @contextlib.contextmanager
+    def admit(self, ticket, size):
+        # Обратное давление: не начинаем выгрузку, пока для нее нет места
+        start = time.time()
+        with self.condition:
+            def full():
+                return self.quota > 0 and self.used + self.reserved + size > self.quota and \
+                    not (self.idle and ticket == min(self.tasks))
+            if full():
+                log('Scratch quota exceeded ({} MB used, {} MB reserved), waiting'.format(
+                    self.used // (1024 * 1024), self.reserved // (1024 * 1024)), level=LOG_DEBUG)
+                while full():
+                    self.condition.wait()
+            self.reserved += size
+        METRICS.observe('scratch_wait', time.time() - start)
+        try:
+            yield
+        finally:
+            # Выгруженные файлы к этому времени уже учтены в used (track)
+            with self.condition:
+                self.reserved -= size
+                self.condition.notify_all()
+
+    def track(self, dir_path, temp_files):
+        with self.condition:
+            for temp_file in temp_files:
+                size = os.path.getsize(temp_file)
+                self.files[temp_file] = (dir_path, size)
+                self.dirs[dir_path] += 1
+                self.used += size
+        if not temp_files:
+            clean(dir_path, write_log=False)
+
+    def release(self, temp_file):
+        with self.condition:
+            if temp_file not in self.files:
+                return
+            dir_path, size = self.files.pop(temp_file)
+            self.used -= size
+            self.dirs[dir_path] -= 1
+            remove = self.dirs[dir_path] <= 0
+            if remove:
+                del self.dirs[dir_path]
+            self.condition.notify_all()
+        if remove:
+            clean(dir_path, write_log=False)
+
+
+# -------------------------------------------------------------------------------------------------
+class LfsStore:
+    """Большие двоичные ревизии коммитятся указателями git LFS, а содержимое складывается в локальное
+    хранилище LFS (устроено как .git/lfs, откуда его отправит git lfs push). Файл, однажды попавший
+    в LFS, остается в нем во всех следующих ревизиях, а нужные строки .gitattributes коммитятся
+    вместе с ним"""
+    ATTRIBUTES = '.gitattributes'
+
+    def __init__(self, path, extensions, threshold):
+        self.path = path
+        self.extensions = set(extension.lower() for extension in extensions)
+        self.threshold = threshold
+        self.objects_path = os.path.join(path, 'objects')
+        self.temp_path = os.path.join(path, 'tmp')
+        make_dir(self.temp_path)
+        self.lock = threading.Lock()
+        self.lines = {}  # строки .gitattributes текущей ветки (упорядоченное множество)
+        self.changed = False
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def attribute_line(pattern):
+        return '{} filter=lfs diff=lfs merge=lfs -text'.format(pattern)
+
+    @staticmethod
+    def pattern(prefix, literal):
+        # Символы шаблона в имени файла экранируем, имена с пробелами берем в кавычки
+        pattern = prefix + re.sub(r'([*?\[])', r'\\\1', literal)
+        return GitFastImport.quote_path(pattern) if re.search(r'[\s"\\]', pattern) else pattern
+
+    def object_path(self, oid):
+        return os.path.join(self.objects_path, oid[0:2], oid[2:4], oid)
+
+    def start_branch(self, git_repo, branch):
+        # Продолжаем .gitattributes ветки, если она уже есть
+        with self.lock:
+            try:
+                text = git_repo.git.show('{}:{}'.format(branch, self.ATTRIBUTES))
+            except Exception:
+                text = ''
+            self.lines = dict.fromkeys(line for line in text.splitlines() if line.strip())
+            self.changed = False
+
+    def store(self, source_path):
+        """Кладет содержимое в хранилище, возвращает путь к файлу-указателю"""
+        sha = hashlib.sha256()
+        with open(source_path, mode='rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        oid = sha.hexdigest()
+        size = os.path.getsize(source_path)
+        path = self.object_path(oid)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_file = os.path.join(self.temp_path, oid + '.' + str(uuid.uuid4()))
+            shutil.copyfile(source_path, temp_file)
+            os.replace(temp_file, path)
+            self.stats['objects'] += 1
+            self.stats['object_bytes'] += size
+        self.stats['revisions'] += 1
+        self.stats['revision_bytes'] += size
+        pointer = os.path.join(self.temp_path, oid + '.pointer')
+        if not os.path.exists(pointer):
+            with open(pointer, mode='w', encoding='ascii', newline='\n') as f:
+                f.write('version https://git-lfs.github.com/spec/v1\noid sha256:{}\nsize {}\n'.format(oid, size))
+        return pointer
+
+    def route(self, repo_path, source_path):
+        """Путь к тому, что нужно закоммитить: указатель LFS или сам файл"""
+        extension = os.path.splitext(repo_path)[1][1:]
+        path_line = self.attribute_line(self.pattern('/', repo_path))
+        if extension and extension.lower() in self.extensions:
+            line = self.attribute_line(self.pattern('*.', extension))
+        elif path_line in self.lines or (self.threshold > 0 and os.path.getsize(source_path) > self.threshold):
+            line = path_line
+        else:
+            return source_path
+        with METRICS.timer('lfs_store'), self.lock:
+            if line not in self.lines:
+                self.lines[line] = None
+                self.changed = True
+            return self.store(source_path)
+
+    def attributes(self):
+        """Путь к новому .gitattributes, если с прошлого коммита он изменился, иначе None"""
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            path = os.path.join(self.temp_path, self.ATTRIBUTES + '.' + str(uuid.uuid4()))
+            with open(path, mode='w', encoding='utf-8', newline='\n') as f:
+                f.write(''.join(line + '\n' for line in self.lines))
+            return path
+
+    def report(self):
+        log('LFS: {} revisions ({} MB) committed as pointers, {} objects ({} MB) written to {}'.format(
+            self.stats['revisions'], self.stats['revision_bytes'] // (1024 * 1024),
+            self.stats['objects'], self.stats['object_bytes'] // (1024 * 1024), self.path))
+
+    def close(self):
+        clean(self.temp_path, write_log=False)
+
+
+# -------------------------------------------------------------------------------------------------
+class HashCache(SqliteStore):
+    """Хэши файлов, выгруженных для --verify: git blob id и sha256 (для указателей LFS) по пути,
+    размеру и времени изменения. Файлы, которые stcmd при повторной проверке не перевыгрузил,
+    заново не читаются"""
+    TABLES = ('hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, sha256 TEXT)',)
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def file_hashes(file_path):
+        size = os.path.getsize(file_path)
+        sha1 = hashlib.sha1('blob {}\0'.format(size).encode())
+        sha256 = hashlib.sha256()
+        with open(file_path, mode='rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+                sha256.update(chunk)
+        return sha1.hexdigest(), sha256.hexdigest()
+
+    def hashes(self, file_path):
+        stat = os.stat(file_path)
+        with self.lock:
+            row = self.connection.execute('SELECT sha1, sha256 FROM hashes WHERE path = ? AND size = ? AND mtime = ?',
+                                          (file_path, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            self.stats['hits'] += 1
+            return row
+        with METRICS.timer('verify_hash'):
+            sha1, sha256 = self.file_hashes(file_path)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, sha1, sha256) '
+                                    'VALUES (?, ?, ?, ?, ?)', (file_path, stat.st_size, stat.st_mtime, sha1, sha256))
+        self.stats['hashed'] += 1
+        self.stats['hashed_bytes'] += stat.st_size
+        return sha1, sha256
 
 
 # -------------------------------------------------------------------------------------------------
@@ -296,18 +1337,18 @@ def ask_starteam_password(settings):
                                                   format(settings.starteam_login))
     result = settings.starteam_password.strip() != ''
     if not result:
-        log('ERROR: Empty password!')
+        log('ERROR: Empty password!', level=LOG_ERROR)
     return result
 
 
 # -------------------------------------------------------------------------------------------------
-def git_init(git_url):
+def git_init(repo_path, git_url):
     # bare_repo = Repo.init(os.path.join(DIR_GIT_BARE_REPO, 'bare-repo'), bare=True)
     # del bare_repo
     # cloned_repo = Repo.clone_from(DIR_GIT_BARE_REPO, DIR_GIT_REPO)
     # log('Success repo init for path={}'.format(DIR_GIT_BARE_REPO))
     # return cloned_repo
-    git_repo = Repo.init(PATH_GIT_REPO)
+    git_repo = Repo.init(repo_path)
     origin = git_repo.create_remote('origin', git_url)
     exists = origin.exists()
     # log('{}'.format(exists))
@@ -321,244 +1362,1372 @@ def git_init(git_url):
 
 
 # -------------------------------------------------------------------------------------------------
-def git_add_file(git_repo, file_path, file_name, author, date, comment, revision):
-    full_path = os.path.join(PATH_GIT_REPO, file_path, file_name)
-    LOCK.acquire(True)
+def git_open(repo_path):
+    # Продолжение прерванной миграции: репозиторий уже создан
+    git_repo = Repo(repo_path)
+    index_lock = os.path.join(git_repo.git_dir, 'index.lock')
+    if os.path.exists(index_lock):  # остался от убитого процесса
+        os.remove(index_lock)
+    if 'origin' in [remote.name for remote in git_repo.remotes]:
+        return git_repo
+    else:
+        return None
+
+
+# -------------------------------------------------------------------------------------------------
+def git_switch_branch(git_repo, branch):
+    # Каждый вид коммитится в свою ветку: существующую продолжаем, новую начинаем с пустого дерева
+    if git_repo.head.reference.name == branch:
+        return
+    if branch in [head.name for head in git_repo.heads]:
+        git_repo.git.checkout('-f', branch)
+    else:
+        git_repo.git.checkout('--orphan', branch)
+        git_repo.git.rm('-rfq', '--ignore-unmatch', '.')
+    git_repo.git.clean('-fdxq')
+    log('Switched to branch {}'.format(branch))
+
+
+# -------------------------------------------------------------------------------------------------
+def git_add_files(git_repo, entries, author, date, comment, what):
+    err_str = None
+    with METRICS.timer('git_lock_wait'):
+        GIT_WRITERS.acquire()
     try:
         success = False
         try:
-            git_repo.index.add([full_path])
+            with METRICS.timer('git_index_add'):
+                git_repo.index.add(entries)
         except Exception as exc:
             err_str = str(exc)
-            if need_retry(str(exc)):
-                return retry(err_str, git_add_file, git_repo, file_path, file_name, author, date, comment, revision)
-            else:
+            if not need_retry(err_str):
                 kill_app('Add exception: {}'.format(exc))
+            return  # повторяем уже без блокировки, чтобы не останавливать остальные потоки
 
         try:
             git_author = Actor(author, '')
             commit_time = st_time_to_utc(date)
-            git_repo.index.commit('{}'.format(comment) if comment else '',
-                                  head=True,
-                                  author=git_author,
-                                  commit_date=commit_time)
+            with METRICS.timer('git_commit'):
+                git_repo.index.commit('{}'.format(comment) if comment else '',
+                                      head=True,
+                                      author=git_author,
+                                      author_date=commit_time,
+                                      commit_date=commit_time)
             #git_repo.active_branch.commit = git_repo.commit('master')
             success = True
         except Exception as exc:
             kill_app('Commit exception: {}'.format(exc))
 
         try:
-            git_repo.active_branch.commit = git_repo.commit('master')
+            git_repo.active_branch.commit = git_repo.head.commit
         except Exception as exc:
             kill_app('Active_branch set up exception: {}'.format(exc))
 
         if success:
-            log('Committed {} rev {}'.format(full_path, revision))
+            log('Committed {}'.format(what))
         else:
-            log('NOT committed {} rev {}'.format(full_path, revision))
+            log('NOT committed {}'.format(what), level=LOG_ERROR)
     finally:
-        LOCK.release()
+        GIT_WRITERS.release()
+        if err_str:
+            retry(err_str, git_add_files, git_repo, entries, author, date, comment, what)
 
 
 # -------------------------------------------------------------------------------------------------
-def st_list_anything(settings, command, extra, what, st_path):
-    launch_string = quote(settings.stcmd)
-    launch_string += ' {} {} -nologo -x  -p "{}:{}@{}:{}/{}/{}/{}" -cfgl {}'.format(
-        command,
-        extra,
-        settings.starteam_login,
-        settings.starteam_password,
-        settings.starteam_server,
-        settings.starteam_port,
-        settings.starteam_project,
-        settings.starteam_view,
-        st_path,
-        quote(settings.view_label))
-    message_text = 'Loading {} from Starteam path="{}". Please wait...'.format(what, st_path)
-    log(message_text)
+class GitFastImport:
+    """Коммиты пишутся потоком в один долгоживущий процесс git fast-import,
+    без рабочего каталога и индекса"""
+    def __init__(self, git_repo, journal=None, checkpoint_interval=0, branch=GIT_BRANCH):
+        self.git_repo = git_repo
+        self.ref = 'refs/heads/' + branch
+        self.committer = Actor.committer(git_repo.config_reader())
+        self.lock = threading.Lock()
+        self.journal = journal
+        self.checkpoint_interval = checkpoint_interval
+        self.pending = []  # ревизии, которые попадут в журнал после очередного checkpoint
+        # При продолжении миграции ветка уже есть, первый коммит нужно сделать от нее
+        self.parent = git_repo.commit(branch).hexsha if self.ref in [ref.path for ref in git_repo.references] \
+            else None
+        self.process = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'],
+                                        cwd=git_repo.working_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @staticmethod
+    def quote_path(path):
+        return '"{}"'.format(path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+    def write(self, text):
+        self.process.stdin.write(text.encode('utf-8'))
+
+    def write_data(self, data):
+        self.write('data {}\n'.format(len(data)))
+        self.process.stdin.write(data)
+        self.write('\n')
+
+    def write_file_data(self, source_path):
+        self.write('data {}\n'.format(os.path.getsize(source_path)))
+        with open(source_path, mode='rb') as f:
+            shutil.copyfileobj(f, self.process.stdin)
+        self.write('\n')
+
+    def write_header(self, author, email, timestamp, message):
+        self.write('commit {}\n'.format(self.ref))
+        self.write('author {} <{}> {} +0000\n'.format(author, email, timestamp))
+        self.write('committer {} <{}> {} +0000\n'.format(self.committer.name, self.committer.email, timestamp))
+        self.write_data(message.encode('utf-8'))
+        if self.parent:
+            self.write('from {}\n'.format(self.parent))
+            self.parent = None
+
+    def replay(self, author, email, timestamp, message, changes, contents=()):
+        """Повтор готового коммита при слиянии шардов. changes - список (режим, sha1 блоба, путь),
+        для удаленных файлов sha1 = None. Блобы уже должны быть в репозитории.
+        contents - список (путь, содержимое) файлов, которые пишутся заново"""
+        with self.lock:
+            self.write_header(author, email, timestamp, message)
+            for mode, blob_sha, repo_path in changes:
+                if blob_sha:
+                    self.write('M {} {} {}\n'.format(mode, blob_sha, self.quote_path(repo_path)))
+                else:
+                    self.write('D {}\n'.format(self.quote_path(repo_path)))
+            for repo_path, data in contents:
+                self.write('M 100644 inline {}\n'.format(self.quote_path(repo_path)))
+                self.write_data(data)
+            self.write('\n')
+
+    def commit(self, files, author, date, comment, journal_items=()):
+        """files - список пар (путь в репозитории, путь к файлу с содержимым)"""
+        timestamp = st_time_to_timestamp(date)
+        message = '{}'.format(comment) if comment else ''
+        with METRICS.timer('git_lock_wait'):
+            self.lock.acquire()
+            GIT_WRITERS.acquire()
+        try:
+            start = time.time()
+            self.write_header(author, '', timestamp, message)
+            for repo_path, source_path in files:
+                self.write('M 100644 inline {}\n'.format(self.quote_path(repo_path)))
+                self.write_file_data(source_path)
+            self.write('\n')
+            self.pending.extend(journal_items)
+            METRICS.observe('git_commit', time.time() - start)
+            if self.checkpoint_interval > 0 and len(self.pending) >= self.checkpoint_interval:
+                with METRICS.timer('fast_import_checkpoint'):
+                    self.checkpoint()
+        finally:
+            GIT_WRITERS.release()
+            self.lock.release()
+
+    def checkpoint(self):
+        # Коммиты fast-import становятся видны в репозитории только после checkpoint,
+        # поэтому в журнал они попадают только после его завершения
+        self.write('checkpoint\nprogress checkpoint\n')
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                kill_app('git fast-import terminated during checkpoint')
+            if line.startswith(b'progress checkpoint'):
+                break
+        self.flush_journal()
+
+    def publish(self):
+        """Делает записанные коммиты видимыми в репозитории (ветка, объекты) для git repack, push
+        и других процессов git, возвращает репозиторий"""
+        with self.lock:
+            self.checkpoint()
+        return self.git_repo
+
+    def flush_journal(self):
+        if self.journal and self.pending:
+            self.journal.mark_committed(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.write('done\n')
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            kill_app('git fast-import exited with code {}'.format(self.process.returncode))
+        self.flush_journal()
+        # Рабочий каталог приводим к последнему коммиту, как после обычной загрузки
+        if self.ref in [ref.path for ref in self.git_repo.references]:
+            self.git_repo.git.checkout('-f', GIT_BRANCH)
+
+
+# -------------------------------------------------------------------------------------------------
+class GitMaintenance:
+    """Обслуживание базы объектов во время долгой загрузки: раз в interval коммитов незапакованные
+    объекты пакуются в новый пакет, пакеты сводятся в multi-pack-index, история - в commit-graph,
+    чтобы поиск объектов и коммитов не замедлялся к концу загрузки. В конце - полная перепаковка"""
+    def __init__(self, interval, final_repack):
+        self.interval = interval
+        self.final_repack = final_repack
+        self.commits = 0
+
+    @staticmethod
+    def objects_stat(git_repo):
+        stat = dict(line.split(': ', 1) for line in git_repo.git.count_objects('-v').splitlines())
+        return int(stat.get('count', 0)), int(stat.get('packs', 0))
+
+    def on_commit(self, git_repo):
+        self.commits += 1
+        if self.interval <= 0 or self.commits % self.interval:
+            return
+        if isinstance(git_repo, GitFastImport):
+            git_repo = git_repo.publish()
+        with GIT_WRITERS:
+            self.run(git_repo)
+
+    def run(self, git_repo):
+        start = time.time()
+        loose, packs = self.objects_stat(git_repo)
+        try:
+            with METRICS.timer('git_maintenance'):
+                git_repo.git.repack('-d', '-q')
+                git_repo.git.multi_pack_index('write')
+                git_repo.git.commit_graph('write', '--reachable', '--split')
+        except Exception as exc:
+            # Без обслуживания загрузка все равно продолжится, только медленнее
+            log('Git maintenance failed ({})'.format(exc), level=LOG_WARNING)
+            return
+        METRICS.count('git_maintenance')
+        log('Git maintenance after {} commits: {} loose objects packed, {} packs, {:.1f} sec'.format(
+            self.commits, loose, packs + 1, time.time() - start))
+
+    def finish(self, git_repo):
+        if not self.final_repack:
+            return
+        log('Repacking repository {}. Please wait...'.format(git_repo.git_dir))
+        start = time.time()
+        try:
+            with METRICS.timer('git_final_repack'):
+                git_repo.git.repack('-a', '-d', '-q', '--write-bitmap-index')
+                git_repo.git.multi_pack_index('write')
+                git_repo.git.commit_graph('write', '--reachable')
+        except Exception as exc:
+            log('Final repack failed ({})'.format(exc), level=LOG_WARNING)
+            return
+        log('Repository repacked in {}'.format(format_duration(time.time() - start)))
+
+
+# -------------------------------------------------------------------------------------------------
+class BackgroundPush:
+    """Пока идет загрузка, готовая история отправляется в origin из отдельного потока - раз в interval
+    коммитов или раз в period секунд. git push передает только объекты, которых еще нет у origin
+    (тонкими пакетами), поэтому после неудачной отправки следующая продолжает от последнего
+    принятого коммита, а в конце загрузки остается отправить только хвост"""
+    def __init__(self, git_repo, branches, interval, period, thread_name='push'):
+        self.working_dir = git_repo.working_dir
+        self.branches = branches
+        self.interval = interval
+        self.period = period
+        self.commits = 0
+        self.pushed = {}  # ветка -> последний коммит, принятый origin
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.worker, name=thread_name, daemon=True)
+        self.thread.start()
+
+    def on_commit(self, git_repo):
+        self.commits += 1
+        if self.interval <= 0 or self.commits % self.interval:
+            return
+        if isinstance(git_repo, GitFastImport):
+            git_repo.publish()
+        self.wake.set()
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            self.wake.wait(self.period if self.period > 0 else None)
+            self.wake.clear()
+            if not self.stop_event.is_set():
+                self.push()
+
+    def push(self):
+        refspecs = []
+        for branch in self.branches:
+            process = subprocess.run(['git', 'rev-parse', '--verify', '-q', 'refs/heads/' + branch],
+                                     cwd=self.working_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            head = process.stdout.decode().strip()
+            if head and head != self.pushed.get(branch):
+                # Отправляем коммит, а не ветку: она может сдвинуться, пока идет отправка
+                refspecs.append((branch, head))
+        if not refspecs:
+            return True
+        start = time.time()
+        with METRICS.timer('git_push'):
+            process = subprocess.run(['git', 'push', '--thin', '--quiet', 'origin'] +
+                                     ['{}:refs/heads/{}'.format(head, branch) for branch, head in refspecs],
+                                     cwd=self.working_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            METRICS.count('push_failures')
+            log('Push to origin failed, will retry ({})'.format(decode(process.stderr).strip()), level=LOG_WARNING)
+            return False
+        self.pushed.update(refspecs)
+        METRICS.count('pushes')
+        log('Pushed {} to origin in {:.1f} sec'.format(
+            ', '.join('{} {}'.format(branch, head[:10]) for branch, head in refspecs), time.time() - start))
+        return True
+
+    def finish(self):
+        self.stop_event.set()
+        self.wake.set()
+        self.thread.join()
+        for attempt in range(1, STCMD_LIMITER.retry_limit + 2):
+            if self.push():
+                return
+            if attempt <= STCMD_LIMITER.retry_limit:
+                time.sleep(min(STCMD_LIMITER.retry_max_delay, STCMD_LIMITER.retry_delay * 2 ** (attempt - 1)))
+        log('ERROR: history is not pushed to origin, push {} manually'.format(', '.join(self.branches)),
+            level=LOG_ERROR)
 
-    process = subprocess.Popen(launch_string, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    process.stdout.close()
+
+# -------------------------------------------------------------------------------------------------
+def git_store_blob(git_repo, file_path):
+    with METRICS.timer('git_store_blob'), open(file_path, mode='rb') as f:
+        return git_repo.odb.store(IStream(Blob.type, os.path.getsize(file_path), f)).binsha
+
+
+# -------------------------------------------------------------------------------------------------
+def git_log_changes(git_repo, ref):
+    """Коммиты ветки от первого к последнему: (время, автор, email, комментарий, изменения),
+    изменения - как в GitFastImport.replay"""
+    process = subprocess.Popen(['git', 'log', '--reverse', '--no-renames', '--raw', '--no-abbrev', '-z',
+                                '--format=%H%x00%an%x00%ae%x00%at%x00%B', ref],
+                               cwd=git_repo.working_dir, stdout=subprocess.PIPE)
+
+    def tokens():
+        tail = b''
+        while True:
+            chunk = process.stdout.read(1024 * 1024)
+            if not chunk:
+                break
+            parts = (tail + chunk).split(b'\0')
+            tail = parts.pop()
+            for part in parts:
+                yield part.decode('utf-8')
+        if tail:
+            yield tail.decode('utf-8')
+
+    stream = tokens()
+    token = next(stream, None)
+    while token is not None:
+        # Запись коммита: sha1, автор, email, время, комментарий, затем пары ":режимы sha1 sha1 статус", путь
+        author, email, timestamp, message = next(stream), next(stream), int(next(stream)), next(stream)
+        changes = []
+        token = next(stream, None)
+        while token is not None and token.lstrip('\n').startswith(':'):
+            _, new_mode, _, new_sha, status = token.lstrip('\n')[1:].split(' ')
+            changes.append((new_mode, None if status == 'D' else new_sha, next(stream)))
+            token = next(stream, None)
+        yield timestamp, author, email, message, changes
+    if process.wait() != 0:
+        kill_app('git log {} exited with code {}'.format(ref, process.returncode))
+
+
+# -------------------------------------------------------------------------------------------------
+def git_change_order(commit):
+    timestamp, _, _, _, changes = commit
+    return timestamp, min((path for _, _, path in changes), default='')
+
+
+# -------------------------------------------------------------------------------------------------
+def git_sorted_changes(git_repo, ref):
+    # В памяти только пути и sha1 изменений, содержимое файлов остается в базе объектов git
+    commits = sorted(git_log_changes(git_repo, ref), key=git_change_order)
+    log('Read {} commits of {}'.format(len(commits), ref))
+    return commits
+
+
+# -------------------------------------------------------------------------------------------------
+def shard_lfs_objects(source):
+    # Хранилище LFS шарда по умолчанию лежит в его репозитории (_REPO.shardN/.git/lfs)
+    for path in (os.path.join(source, '.git', 'lfs', 'objects'), os.path.join(source, 'lfs', 'objects')):
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+# -------------------------------------------------------------------------------------------------
+def copy_lfs_objects(source_objects, target_objects):
+    """Копирует объекты LFS, которых еще нет в целевом хранилище, возвращает (число, байт)"""
+    copied = size = 0
+    if os.path.abspath(source_objects) == os.path.abspath(target_objects):
+        return copied, size  # шарды писали в общее хранилище LfsStore
+    for directory, _, files in os.walk(source_objects):
+        for file_name in files:
+            source_path = os.path.join(directory, file_name)
+            target_path = os.path.join(target_objects, os.path.relpath(source_path, source_objects))
+            if os.path.exists(target_path):
+                continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            temp_file = target_path + '.' + str(uuid.uuid4())
+            shutil.copyfile(source_path, temp_file)
+            os.replace(temp_file, target_path)
+            copied += 1
+            size += os.path.getsize(target_path)
+    return copied, size
+
+
+# -------------------------------------------------------------------------------------------------
+def git_merge_shards(git_repo, sources, lfs_path, branch=GIT_BRANCH):
+    """Коммиты шардов переплетаются по времени StarTeam в одну линейную историю.
+    Шарды содержат непересекающиеся папки, поэтому изменения каждого коммита переносятся как есть,
+    кроме .gitattributes: в общей истории он объединяет строки всех шардов. Объекты LFS шардов
+    копируются в хранилище lfs_path. Возвращает False, если шард с LFS недоступен как каталог"""
+    refs = []
+    for index, source in enumerate(sources, 1):
+        ref = 'refs/shards/{}/{}'.format(index, branch)
+        local = os.path.exists(source)
+        if local:
+            source = os.path.abspath(source)  # git fetch выполняется из каталога репозитория
+        log('Fetching branch {} of shard {} from {}'.format(branch, index, source))
+        git_repo.git.fetch('--no-tags', source, '+{}:{}'.format(branch, ref))
+        refs.append(ref)
+        try:
+            attributes = git_repo.git.show('{}:{}'.format(ref, LfsStore.ATTRIBUTES))
+        except Exception:
+            attributes = ''
+        if 'filter=lfs' not in attributes:
+            continue
+        objects = shard_lfs_objects(source) if local else None
+        if objects is None:
+            # Указатели без объектов дали бы репозиторий, в котором большие файлы не восстановить
+            log('ERROR: shard {} has LFS files, but its LFS objects are not found: merge shards from their '
+                'local repository directories'.format(source), level=LOG_ERROR)
+            for ref in refs:
+                git_repo.git.update_ref('-d', ref)
+            return False
+        copied, size = copy_lfs_objects(objects, os.path.join(lfs_path, 'objects'))
+        log('Copied {} LFS objects ({} MB) of shard {} to {}'.format(copied, size // (1024 * 1024), index, lfs_path))
+    fast_import = GitFastImport(git_repo, branch=branch)
+    attribute_lines = {}  # строки .gitattributes всех шардов (упорядоченное множество)
+    commits = 0
+    # heapq.merge требует упорядоченных по времени потоков, а шард, перенесенный без ChangesetWindow,
+    # коммитит папку за папкой. Поэтому коммиты каждого шарда сортируются по (время, путь): ревизии
+    # одного файла идут по возрастанию времени, при равном времени порядок шарда сохраняется (сортировка
+    # устойчивая), при равном времени в разных шардах раньше идет шард с меньшим номером
+    for timestamp, author, email, message, changes in heapq.merge(*[git_sorted_changes(git_repo, ref) for ref in refs],
+                                                                 key=git_change_order):
+        contents = []
+        for _, blob_sha, repo_path in changes:
+            if repo_path == LfsStore.ATTRIBUTES and blob_sha:
+                attribute_lines.update(dict.fromkeys(line for line in git_repo.git.cat_file('blob', blob_sha).splitlines()
+                                                     if line.strip()))
+                contents.append((repo_path, ''.join(line + '\n' for line in attribute_lines).encode('utf-8')))
+        changes = [change for change in changes if change[2] != LfsStore.ATTRIBUTES]
+        fast_import.replay(author, email, timestamp, message, changes, contents)
+        commits += 1
+        if commits % 1000 == 0:
+            log('Merged {} commits'.format(commits))
+    fast_import.close()
+    for ref in refs:
+        git_repo.git.update_ref('-d', ref)
+    log('Merged {} commits from {} shards into {}'.format(commits, len(refs), branch))
+    return True
+
+
+# -------------------------------------------------------------------------------------------------
+def git_commit_changeset(settings, git_repo, changeset):
+    """changeset - список пар (ревизия, выгруженный файл) одного автора с одним комментарием,
+    коммитятся одним коммитом с датой последней ревизии"""
+    cache = settings.blob_cache
+    journal_items = [(item.path, item.filename, item.revision) for item, _ in changeset]
+    files = [(item, temp_file) for item, temp_file in changeset
+             if not (cache and cache.is_unchanged(item.path + item.filename, temp_file))]
+    first_item = changeset[0][0]
+    last_item = changeset[-1][0]
+    what = ', '.join('{}{} rev {}'.format(item.path, item.filename, item.revision) for item, _ in files)
+    METRICS.count('revisions', len(changeset))
+    settings.progress.count('revisions_done', len(changeset))
+    if files:
+        METRICS.count('commits')
+    if not files:
+        log('Skipped {} rev {}: content not changed'.format(first_item.path + first_item.filename, first_item.revision)
+            if len(changeset) == 1 else 'Skipped changeset of {} revisions: content not changed'.format(len(changeset)))
+        if settings.journal:
+            settings.journal.mark_committed(journal_items)
+    else:
+        # Большие двоичные ревизии коммитятся указателями LFS
+        lfs = settings.lfs
+        contents = [(item.path + item.filename, lfs.route(item.path + item.filename, temp_file) if lfs else temp_file)
+                    for item, temp_file in files]
+        attributes = lfs.attributes() if lfs else None
+        if attributes:
+            contents.append((LfsStore.ATTRIBUTES, attributes))
+        if isinstance(git_repo, GitFastImport):
+            try:
+                git_repo.commit(contents, first_item.author, last_item.date, first_item.comment, journal_items)
+            except Exception as exc:
+                kill_app('fast-import exception: {}'.format(exc))
+            log('Committed {}'.format(what))
+        else:
+            if settings.direct_import:
+                # Содержимое пишется сразу в базу объектов git, без рабочего каталога
+                entries = [BaseIndexEntry((0o100644, git_store_blob(git_repo, content), 0, repo_path))
+                           for repo_path, content in contents]
+            else:
+                temp_files = set(temp_file for _, temp_file in files)
+                for repo_path, content in contents:
+                    # Указатели LFS и .gitattributes копируем, выгруженные файлы переносим (из кэша - копируем)
+                    st_path, st_file = os.path.split(repo_path)
+                    move_to_repo(content, settings.repo_path, st_path, st_file,
+                                 keep_source=cache is not None or content not in temp_files)
+                entries = [os.path.join(settings.repo_path, repo_path) for repo_path, _ in contents]
+            git_add_files(git_repo,
+                          entries,
+                          first_item.author,
+                          last_item.date,
+                          first_item.comment,
+                          what)
+            if settings.journal:
+                settings.journal.mark_committed(journal_items)
+        if attributes:
+            os.remove(attributes)
+        if settings.maintenance:
+            settings.maintenance.on_commit(git_repo)
+        if settings.pusher:
+            settings.pusher.on_commit(git_repo)
+    for _, temp_file in changeset:
+        if cache:
+            cache.release(temp_file)
+        settings.scratch.release(temp_file)
+
+
+# -------------------------------------------------------------------------------------------------
+def mark_absent(settings, items):
+    # Ревизии, которые stcmd co не выгрузил (файл удален из StarTeam), запоминаем в журнале,
+    # чтобы --resume и --sync не выгружали их снова по одной
+    if not items:
+        return
+    settings.progress.count('revisions_done', len(items))
+    if settings.journal:
+        settings.journal.mark_absent([(item.path, item.filename, item.revision) for item in items])
+
+
+# -------------------------------------------------------------------------------------------------
+def build_changesets(histories, window):
+    """Группирует ревизии всех папок в наборы изменений: одного автора, с одним комментарием,
+    не дальше window секунд друг от друга. Наборы возвращаются по времени последней ревизии
+    (с ним набор коммитится), ревизии одного файла попадают в наборы по порядку"""
+    items = sorted(((st_time_to_timestamp(item.date), item)
+                    for dict_history in histories.values()
+                    for history in dict_history.values()
+                    for item in history),
+                   key=lambda pair: (pair[0], pair[1].path, pair[1].filename, pair[1].revision))
+    changesets = []  # (время последней ревизии, порядок закрытия, ревизии)
+    open_changesets = {}  # (автор, комментарий) -> [время последней ревизии, ревизии]
+    file_changesets = {}  # путь к файлу -> (ключ, набор) с его предыдущей ревизией
+
+    def close(changeset_key):
+        changeset = open_changesets.pop(changeset_key)
+        changesets.append((changeset[0], len(changesets), changeset[1]))
+
+    for timestamp, item in items:
+        repo_path = item.path + item.filename
+        changeset_key = (item.author, item.comment)
+        # Набор с предыдущей ревизией файла закрываем, чтобы следующая ревизия оказалась после него
+        previous_key, previous_changeset = file_changesets.get(repo_path, (None, None))
+        if previous_changeset is not None and open_changesets.get(previous_key) is previous_changeset:
+            close(previous_key)
+        if changeset_key in open_changesets and timestamp - open_changesets[changeset_key][0] > window:
+            close(changeset_key)
+        if changeset_key not in open_changesets:
+            open_changesets[changeset_key] = [timestamp, []]
+        changeset = open_changesets[changeset_key]
+        changeset[0] = timestamp
+        changeset[1].append(item)
+        file_changesets[repo_path] = (changeset_key, changeset)
+
+    for changeset_key in sorted(open_changesets.keys(),
+                                key=lambda k: st_time_to_timestamp(open_changesets[k][1][0].date)):
+        close(changeset_key)
+    # Наборы закрываются не по времени: набор с разовым комментарием остается открытым до конца.
+    # Набор с предыдущей ревизией файла закрыт раньше набора со следующей и его последняя ревизия
+    # не позже, поэтому сортировка по (время последней ревизии, порядок закрытия) сохраняет порядок
+    # ревизий каждого файла, а даты коммитов не убывают
+    return [changeset for _, _, changeset in sorted(changesets, key=lambda closed: closed[:2])]
+
+
+# -------------------------------------------------------------------------------------------------
+def changeset_downloads(settings, histories, changesets):
+    """Делит ревизии папок на задачи выгрузки в порядке наборов изменений. С ScratchQuota задача
+    папки - не больше ScratchQuota / DownloadWorkers ожидаемых байт, иначе вся история папки.
+    Возвращает список задач (папка, ревизии, снимок на метке, первый и последний набор)
+    и словарь (папка, файл, ревизия) -> номер задачи"""
+    limit = settings.scratch.quota // max(1, settings.download_workers) if settings.scratch.quota > 0 else 0
+    tasks = []
+    item_tasks = {}
+    open_tasks = {}  # папка -> [номер задачи, ожидаемый размер]
+    for index, changeset in enumerate(changesets):
+        for item in changeset:
+            size = expected_size(settings, item.path, [(item.filename, item.revision)])
+            current = open_tasks.get(item.path)
+            if current is None or limit and current[1] + size > limit and tasks[current[0]][1]:
+                current = open_tasks[item.path] = [len(tasks), 0]
+                tasks.append([item.path, {}, True, index, index])
+            task = tasks[current[0]]
+            task[1].setdefault(item.filename, []).append(item)
+            task[4] = index
+            current[1] += size
+            item_tasks[(item.path, item.filename, item.revision)] = current[0]
+    for task in tasks:
+        # Снимком на метке выгружаются последние ревизии файлов, только если они в этой же задаче
+        full_history = histories[task[0]]
+        task[2] = all(history[-1] is full_history[file_name][-1] for file_name, history in task[1].items())
+    return [tuple(task) for task in tasks], item_tasks
+
+
+# -------------------------------------------------------------------------------------------------
+def st_commit_changesets(settings, git_repo, histories):
+    changesets = build_changesets(histories, settings.changeset_window)
+    log('{} revisions grouped into {} changesets'.format(sum(len(changeset) for changeset in changesets),
+                                                         len(changesets)))
+    # Задачи, которые нужны уже текущему набору, выгружаются сразу. Сверх них, пока выгрузок
+    # меньше PipelineQueue и выгруженное помещается в ScratchQuota, первой берется самая дорогая
+    # (по числу вызовов stcmd co) из ближайших ScheduleWindow задач
+    tasks, item_tasks = changeset_downloads(settings, histories, changesets)
+    costs = [len(st_plan_checkouts(settings, dict_history, snapshot=snapshot))
+             for _, dict_history, snapshot, _, _ in tasks]
+    workers = max(1, settings.download_workers)
+    report_schedule('{} download tasks for changesets'.format(len(tasks)), costs, workers)
+    downloader = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                       thread_name_prefix=settings.thread_name('download'))
+    downloads = {}
+    submitted = set()
+    ranked = []  # (-стоимость, номер задачи) ближайших задач, еще не отправленных
+    next_task = 0  # первая задача, которая еще не отправлена
+    next_ranked = 0  # задачи до этой уже в ranked или отправлены
+
+    def submit(task_index):
+        st_path, dict_history, snapshot, _, _ = tasks[task_index]
+        downloads[task_index] = downloader.submit(st_download_revisions, settings, st_path, dict_history, snapshot)
+        submitted.add(task_index)
+
+    try:
+        for index, changeset in enumerate(changesets):
+            while next_task < len(tasks) and (next_task in submitted or tasks[next_task][3] <= index):
+                if next_task not in submitted:
+                    submit(next_task)
+                next_task += 1
+            while len(downloads) < settings.pipeline_queue and settings.scratch.has_room():
+                while next_ranked < min(len(tasks), next_task + max(1, settings.schedule_window)):
+                    heapq.heappush(ranked, (-costs[next_ranked], next_ranked))
+                    next_ranked += 1
+                while ranked and ranked[0][1] in submitted:
+                    heapq.heappop(ranked)
+                if not ranked:
+                    break
+                submit(heapq.heappop(ranked)[1])
+            files = []
+            absent = []
+            for item in changeset:
+                future = downloads[item_tasks[(item.path, item.filename, item.revision)]]
+                if not future.done():
+                    with settings.scratch.committer_idle():
+                        concurrent.futures.wait([future])
+                temp_file = future.result()[(item.filename, item.revision)]
+                if temp_file:
+                    files.append((item, temp_file))
+                else:
+                    absent.append(item)
+            mark_absent(settings, absent)
+            if files:
+                git_commit_changeset(settings, git_repo, files)
+            for task_index in set(item_tasks[(item.path, item.filename, item.revision)] for item in changeset):
+                if tasks[task_index][4] == index:
+                    del downloads[task_index]  # больше не нужна, выгруженные файлы уже освобождены
+    finally:
+        # При ошибке не ждем выгрузок, которые еще не начались
+        for future in downloads.values():
+            future.cancel()
+        downloader.shutdown()
+
+
+# -------------------------------------------------------------------------------------------------
+class StarteamRetry(Exception):
+    """Ошибка stcmd, после которой команду нужно повторить (см. ERROR_MESSAGES)"""
+    pass
+
+
+# -------------------------------------------------------------------------------------------------
+def st_stream_anything(settings, command, extra, what, st_path, header=False, st_files=()):
+    """Выдает строки вывода stcmd по мере чтения, без первой строки (путь к виду стартима),
+    если не задан header. st_files - только эти файлы папки"""
+    launch_args = [settings.stcmd, command] + extra.split() + \
+                  ['-nologo', '-x', '-p', st_connection_string(settings, st_path)] + settings.configuration() + \
+                  list(st_files)
+    message_text = 'Loading {} from Starteam path="{}". Please wait...'.format(what, st_path)
+    log(message_text, level=LOG_DEBUG)
+
+    with STCMD_LIMITER.slot(settings.job_name), METRICS.timer('stcmd_' + command, st_path):
+        start = time.time()
+        process = subprocess.Popen(launch_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # stderr читаем в отдельном потоке, чтобы процесс не встал на переполненном канале
+        err_chunks = []
+        err_reader = threading.Thread(target=lambda: err_chunks.append(process.stderr.read()))
+        err_reader.start()
+        lines_count = 0
+        chars_count = 0
+        with io.TextIOWrapper(process.stdout, encoding='windows-1251', errors='replace') as out:
+            for line in out:
+                lines_count += 1
+                chars_count += len(line)
+                if lines_count == 1:
+                    # Запуск процесса, вход на сервер и выполнение запроса до первой строки ответа
+                    METRICS.observe('stcmd_startup', time.time() - start)
+                if lines_count > 1 or header:
+                    yield line.rstrip('\r\n')
+        err_reader.join()
+        process.wait()
+    METRICS.count('stcmd_{}_bytes'.format(command), chars_count)  # однобайтовая кодировка: символ - байт
+    err = err_chunks[0] if err_chunks else b''
+    if not err:
+        STCMD_LIMITER.on_success()
     if err:
         err_str = decode(err)
         message_text = 'Can not load {} path="{}".'.format(what, st_path)
         if need_retry(err_str):
-            log(message_text)
-            return retry(err_str, st_list_anything, settings, command, extra, what, st_path)
+            log(message_text, level=LOG_WARNING)
+            raise StarteamRetry(err_str)
         else:
             kill_app(message_text + '\n' + err_str)
-    else:
-        str_res = decode(out)
-        # log('DEBUG OUTPUT: {}'.format(str_res))
-        if str_res:
-            st_list = str_res.splitlines()
-            del st_list[0]  # В первой строке будет путь к виду стартима
-            if command != COMMAND_HIST:
-                st_list.sort()
-            return st_list
+    elif not lines_count:
+        message_text = 'Can not load {} path="{}". NO RESULT'.format(
+            what, st_path)
+        kill_app(message_text)
+
+
+# -------------------------------------------------------------------------------------------------
+class StarteamBroker:
+    """Весь доступ к StarTeam: list, hist и checkout. Каждый запуск stcmd - это новый вход на сервер
+    и в Active Directory, поэтому списки и истории папок глубже tree_depth загружаются одним вызовом
+    stcmd -is на все поддерево и раздаются по папкам из памяти. Вывод разбирается по мере чтения,
+    в памяти остаются только разобранные истории папок, которые еще никто не запросил"""
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.trees = {}  # (команда, вид, метка или время, корень поддерева) -> threading.Event загрузки
+        self.folders = {}  # (команда, вид, метка или время, папка) -> разобранный вывод stcmd, еще не отданный
+        self.done = set()  # (вид, метка или время, папка) - папки, которые больше не запросят
+        self.done_trees = set()  # (вид, метка или время, папка) - то же для папки со всеми подпапками
+        self.stats = collections.Counter()
+
+    def tree_root(self, st_path):
+        depth = self.settings.stcmd_tree_depth
+        parts = st_path.split('/')[:-1]
+        if depth <= 0 or len(parts) < depth:
+            return None
+        return '/'.join(parts[:depth]) + '/'
+
+    @staticmethod
+    def parse_block(command, st_path, lines):
+        # Список папки оставляем строками (их по одной на файл), историю разбираем на ревизии
+        return list(lines) if command == COMMAND_LIST else list(st_parse_history(st_path, lines))
+
+    def split_tree(self, command, root, lines, requested=None):
+        """Делит вывод stcmd -is на папки по заголовкам 'Folder: ... (working dir: ...)' и разбирает
+        каждую папку, как только она прочитана. Путь папки - рабочий каталог относительно рабочего
+        каталога корня поддерева. Возвращает папка -> разобранный вывод или None, если разделить нельзя"""
+        folders = {}
+        base = None
+        current = None
+        block = []
+        can_start = True
+
+        def close_block():
+            if current is not None and (current == requested or not self.is_done(current)):
+                folders[current] = self.parse_block(command, current, block)
+
+        for line in lines:
+            # В истории заголовок папки может быть только после конца блока файла, а не в комментарии
+            match = FOLDER_HEADER.match(line) if can_start or command != COMMAND_HIST else None
+            if match:
+                working_dir = match.group(1).replace('\\', '/').rstrip('/')
+                if base is None:
+                    base = working_dir
+                if working_dir != base and not working_dir.startswith(base + '/'):
+                    return None  # у папки свой рабочий каталог - сопоставить с путем нельзя
+                close_block()
+                relative = working_dir[len(base):].strip('/')
+                current = root + relative + '/' if relative else root
+                block = []
+                can_start = True
+                continue
+            if current is None:
+                return None
+            block.append(line)
+            can_start = line.strip().startswith('=====')
+        close_block()
+        return folders
+
+    def load_tree(self, command, extra, what, root, requested):
+        try:
+            return self.split_tree(command, root, st_stream_anything(self.settings, command, extra + ' -is',
+                                                                     what + ' TREE', root, header=True), requested)
+        except StarteamRetry as e:
+            return retry(str(e), self.load_tree, command, extra, what, root, requested)
+
+    def view_key(self):
+        return self.settings.starteam_view, ' '.join(self.settings.configuration())
+
+    def is_done(self, st_path):
+        key = self.view_key()
+        with self.lock:
+            return key + (st_path,) in self.done or \
+                any(key + (st_path[:index + 1],) in self.done_trees for index, char in enumerate(st_path) if char == '/')
+
+    def forget(self, st_path, subtree=False):
+        """Папка (с subtree - и все ее подпапки) больше не понадобится: ее списки и истории удаляем
+        и при загрузке поддерева не сохраняем"""
+        key = self.view_key()
+        with self.lock:
+            (self.done_trees if subtree else self.done).add(key + (st_path,))
+            for folder_key in [folder_key for folder_key in self.folders if folder_key[1:] == key + (st_path,) or
+                               subtree and folder_key[1:3] == key and folder_key[3].startswith(st_path)]:
+                del self.folders[folder_key]
+
+    def from_tree(self, command, extra, what, st_path):
+        """Разобранный вывод для папки из загрузки поддерева или None, если папки в нем нет"""
+        root = self.tree_root(st_path)
+        if root is None:
+            return None
+        key = (command,) + self.view_key()
+        with self.lock:
+            event = self.trees.get(key + (root,))
+            loader = event is None
+            if loader:
+                event = self.trees[key + (root,)] = threading.Event()
+        if loader:
+            try:
+                folders = self.load_tree(command, extra, what, root, st_path)
+                if folders is None:
+                    log('Can not split {} of "{}" by folders, loading folders one by one'.format(command, root),
+                        level=LOG_WARNING)
+                else:
+                    with self.lock:
+                        self.folders.update((key + (folder,), parsed) for folder, parsed in folders.items())
+                    self.stats['tree_' + command] += 1
+            finally:
+                event.set()
         else:
-            message_text = 'Can not load {} path="{}". NO RESULT'.format(
-                what, st_path)
-            kill_app(message_text)
+            event.wait()
+        with self.lock:
+            parsed = self.folders.pop(key + (st_path,), None)
+        if parsed is not None:
+            self.stats['served_' + command] += 1
+        return parsed
+
+    def list(self, st_path):
+        st_list = self.from_tree(COMMAND_LIST, '-cf', 'FOLDERS', st_path)
+        if st_list is None:
+            try:
+                st_list = list(st_stream_anything(self.settings, COMMAND_LIST, '-cf', 'FOLDERS', st_path))
+            except StarteamRetry as e:
+                return retry(str(e), self.list, st_path)
+        return sorted(st_list)
+
+    def hist(self, st_path, st_files=()):
+        """История папки (или только файлов st_files): пары (файл, ревизии по возрастанию);
+        при чтении может возникнуть StarteamRetry"""
+        if st_files:
+            return st_parse_history(st_path, st_stream_anything(
+                self.settings, COMMAND_HIST, '', 'HISTORY OF {} FILES'.format(len(st_files)), st_path,
+                st_files=st_files))
+        history = self.from_tree(COMMAND_HIST, '', 'HISTORY', st_path)
+        return history if history is not None else \
+            st_parse_history(st_path, st_stream_anything(self.settings, COMMAND_HIST, '', 'HISTORY', st_path))
+
+    def checkout(self, st_path, st_files, version_args, what, target=None, force=True):
+        return st_checkout(self.settings, st_path, st_files, version_args, what, target, force)
+
+    def report(self):
+        if self.settings.stcmd_tree_depth > 0:
+            log('STARTEAM BROKER: {} list and {} hist subtree calls served {} and {} folders'.format(
+                self.stats['tree_' + COMMAND_LIST], self.stats['tree_' + COMMAND_HIST],
+                self.stats['served_' + COMMAND_LIST], self.stats['served_' + COMMAND_HIST]))
 
 
 # -------------------------------------------------------------------------------------------------
-def st_download_one_file(settings, st_path, st_file, root_dir_path, revision):
-    full_temp_path = os.path.join(PATH_TEMP, str(uuid.uuid4()), st_path)
-    launch_string = '"{}" co -nologo -stop -q -x -o -is -p "{}:{}@{}:{}/{}/{}/{}" -fp "{}" -vn {} "{}"'.format(
-        settings.stcmd,
-        settings.starteam_login,
-        settings.starteam_password,
-        settings.starteam_server,
-        settings.starteam_port,
-        settings.starteam_project,
-        settings.starteam_view,
-        st_path,
-        full_temp_path,  # Выгружаем во временный каталог с уникальным названием
-        revision,
-        st_file)
-    message_text = 'Loading FILE from Starteam path="{}{}" rev {} temp_path="{}". Please wait...'.format(
-        st_path, st_file, revision, full_temp_path)
-    log(message_text)
-
-    process = subprocess.Popen(launch_string, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    process.stdout.close()
+def st_checkout(settings, st_path, st_files, version_args, what, target=None, force=True):
+    # По умолчанию выгружаем во временный каталог с уникальным названием. Без force (-o) stcmd
+    # не выгружает повторно файлы, которые в target уже в статусе Current
+    full_temp_path = target or os.path.join(settings.scratch.new_dir(), st_path)
+    launch_args = [settings.stcmd, 'co', '-nologo', '-stop', '-q', '-x'] + (['-o'] if force else []) + \
+                  ['-is', '-p', st_connection_string(settings, st_path), '-fp', full_temp_path] + version_args + st_files
+    message_text = 'Loading {} from Starteam path="{}" temp_path="{}". Please wait...'.format(
+        what, st_path, full_temp_path)
+    log(message_text, level=LOG_DEBUG)
+
+    with STCMD_LIMITER.slot(settings.job_name), METRICS.timer('stcmd_co', st_path):
+        process = subprocess.Popen(launch_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        process.stdout.close()
+    METRICS.count('stcmd_co_files', len(st_files))
+    if not err:
+        STCMD_LIMITER.on_success()
     if err:
         err_str = decode(err)
-        message_text = 'Can not download FILE path="{}{}" rev {}.'.format(st_path, st_file, revision)
+        message_text = 'Can not download {} path="{}".'.format(what, st_path)
         if need_retry(err_str):
-            log(message_text)
-            return retry(err_str, st_download_one_file, settings, st_path, st_file, root_dir_path, revision)
+            log(message_text, level=LOG_WARNING)
+            return retry(err_str, st_checkout, settings, st_path, st_files, version_args, what, target, force)
         else:
             kill_app(message_text + '\n' + err_str)
     else:
-        # Иногда файлы в предыдущих ревизиях имеют другое имя, поэтому
-        # файл выгружается во веменный каталог и переносится из временного
-        # каталога в репозторий с перименованием на актуальное название
-        if os.path.exists(full_temp_path):  # Иногда файл есть в истории, но из стартима уже удален. Тогда
-            files = []                      # ничего не скачается, каталог не будет создан. Это нормально.
-            try:
-                # Выбираем только файлы во временно каталоге (иногда в дереве каталогов несколько
-                # одноименных файлов и выкачиваются они все со вложенными каталогами, они будут
-                # загружены позже, когда доберемся до их уровня в дереве, сойчас пропускаем)
-                files = [f for f in os.listdir(full_temp_path) if os.path.isfile(os.path.join(full_temp_path, f))]
-            except BaseException as e:
-                kill_app('is file ' + str(e))
-            if len(files) != 1:
-                # Если файл все-таки оказался в каталоге не один, то это ошибка. Такого не встерчалось.
-                kill_app('Too many files in temp folder "{}": {}'.format(full_temp_path, files))
-            else:
-                try:
-                    # Создаем каталог в папке репозитория
-                    os.makedirs(os.path.join(root_dir_path, st_path), exist_ok=True)
-                except BaseException as e:
-                    kill_app('mkdir ' + str(e))
-                try:
-                    # Переносим файл в каталог репозитория с новым именем
-                    shutil.move(os.path.join(full_temp_path, files[0]),
-                                os.path.join(root_dir_path, st_path, st_file))
-                    # clean(full_temp_path, write_log=False) решил не удалять временный каталог
-                    return True
-                except BaseException as e:
-                    kill_app('copy ' + str(e))
-        else:
-            # Иногда файл есть в истории, но из стартима уже удален. Тогда
-            # ничего не скачается, каталог не будет создан. Это нормально.
-            log('File {} rev {} not loaded. Possibly it was deleted from StarTeam. Not error.'.format(
-                st_file, revision))
+        return full_temp_path
 
 
 # -------------------------------------------------------------------------------------------------
-def st_download_files_and_commit_to_git(settings, git_repo, list_history, st_path):
+def scratch_dir(settings, full_temp_path):
+    # Каталог выгрузки с уникальным названием - первый уровень внутри временного каталога
+    return os.path.join(settings.scratch.path, os.path.relpath(full_temp_path, settings.scratch.path).split(os.sep)[0])
+
+
+# -------------------------------------------------------------------------------------------------
+def st_files_in_temp(full_temp_path):
+    # Иногда файл есть в истории, но из стартима уже удален. Тогда
+    # ничего не скачается, каталог не будет создан. Это нормально.
+    if not os.path.exists(full_temp_path):
+        return []
     try:
-        for item in list_history:
-            if st_download_one_file(settings, st_path, item[KEY_FILENAME],
-                                    PATH_GIT_REPO, item[KEY_REVISION]):
-                git_add_file(git_repo,
-                             item[KEY_PATH],
-                             item[KEY_FILENAME],
-                             item[KEY_AUTHOR],
-                             item[KEY_DATE],
-                             item[KEY_COMMENT] if KEY_COMMENT in item else None,
-                             item[KEY_REVISION])
+        # Выбираем только файлы во временно каталоге (иногда в дереве каталогов несколько
+        # одноименных файлов и выкачиваются они все со вложенными каталогами, они будут
+        # загружены позже, когда доберемся до их уровня в дереве, сойчас пропускаем)
+        return [f for f in os.listdir(full_temp_path) if os.path.isfile(os.path.join(full_temp_path, f))]
     except BaseException as e:
-        kill_app(str(e))
+        kill_app('is file ' + str(e))
 
 
 # -------------------------------------------------------------------------------------------------
-def st_list_history(settings, st_path):
-    st_list = st_list_anything(settings, COMMAND_HIST, '', 'HISTORY', st_path)
-    if not st_list:
+def st_download_one_file(settings, st_path, st_file, revision):
+    # Иногда файлы в предыдущих ревизиях имеют другое имя, поэтому
+    # файл выгружается во веменный каталог с уникальным названием,
+    # а в репозиторий переносится уже с актуальным названием
+    full_temp_path = settings.broker.checkout(st_path, [st_file], ['-vn', str(revision)],
+                                              'FILE "{}" rev {}'.format(st_file, revision))
+    files = st_files_in_temp(full_temp_path)
+    settings.scratch.track(scratch_dir(settings, full_temp_path),
+                           [os.path.join(full_temp_path, f) for f in files[:1]])
+    if not files:
+        log('File {} rev {} not loaded. Possibly it was deleted from StarTeam. Not error.'.format(
+            st_file, revision))
+    elif len(files) != 1:
+        # Если файл все-таки оказался в каталоге не один, то это ошибка. Такого не встерчалось.
+        kill_app('Too many files in temp folder "{}": {}'.format(full_temp_path, files))
+    else:
+        return os.path.join(full_temp_path, files[0])
+
+
+# -------------------------------------------------------------------------------------------------
+def st_download_batch(settings, st_path, st_files, version_args, what):
+    full_temp_path = settings.broker.checkout(st_path, st_files, version_args, what)
+    files = st_files_in_temp(full_temp_path)
+    unexpected = set(files) - set(st_files)
+    settings.scratch.track(scratch_dir(settings, full_temp_path),
+                           [] if unexpected else [os.path.join(full_temp_path, f) for f in files])
+    if unexpected:
+        # В пакете оказались файлы со старыми именами (переименованные ревизии) - сопоставить
+        # их с актуальными названиями нельзя, такие ревизии выгрузим по одной
+        log('Batch {} path="{}" has unexpected files {}. Falling back to per-file checkout.'.format(
+            what, st_path, sorted(unexpected)), level=LOG_DEBUG)
         return {}
-    history_list = []
-    history_item = {KEY_PATH: st_path}
+    return {f: os.path.join(full_temp_path, f) for f in files}
+
+
+# -------------------------------------------------------------------------------------------------
+def st_plan_checkouts(settings, dict_history, downloaded=(), snapshot=True):
+    """Разбивает ревизии папки на вызовы stcmd co.
+    Возвращает список (параметры версии, описание, [(файл, ревизия), ...]).
+    snapshot=False - последние ревизии не на метке (часть цепочки ревизий файла)"""
+    checkouts = []
+    batch_size = settings.checkout_batch_size
+    if batch_size > 1:
+        # Последняя ревизия каждого файла - это его состояние на метке (или на время синхронизации),
+        # их выгружаем одним снимком, остальные ревизии группируем по номеру ревизии
+        batches = [(settings.configuration(), 'SNAPSHOT {}'.format(' '.join(settings.configuration())),
+                    [(file_name, history[-1].revision) for file_name, history in dict_history.items()
+                     if (file_name, history[-1].revision) not in downloaded])] if snapshot else []
+        revisions = {}
+        for file_name, history in dict_history.items():
+            for item in history[:-1] if snapshot else history:
+                if (file_name, item.revision) not in downloaded:
+                    revisions.setdefault(item.revision, []).append((file_name, item.revision))
+        for revision in sorted(revisions.keys()):
+            batches.append((['-vn', str(revision)], 'REVISION {}'.format(revision), revisions[revision]))
+
+        for version_args, what, keys in batches:
+            for i in range(0, len(keys), batch_size):
+                chunk = keys[i:i + batch_size]
+                if len(chunk) > 1:
+                    checkouts.append((version_args,
+                                      '{} FILES {} ({})'.format(len(chunk), what, i // batch_size + 1), chunk))
+    batched = set(key for _, _, chunk in checkouts for key in chunk)
+    for file_name, history in dict_history.items():
+        for item in history:
+            key = (file_name, item.revision)
+            if key not in downloaded and key not in batched:
+                checkouts.append((['-vn', str(item.revision)], 'FILE "{}" rev {}'.format(file_name, item.revision),
+                                  [key]))
+    return checkouts
+
+
+# -------------------------------------------------------------------------------------------------
+def st_download_revisions(settings, st_path, dict_history, snapshot=True):
+    """Выгружает все ревизии файлов папки минимальным числом вызовов stcmd co.
+    Возвращает словарь (файл, ревизия) -> путь к выгруженному файлу во временном каталоге"""
+    with settings.scratch.task() as ticket:
+        return st_download_task(settings, st_path, dict_history, snapshot, ticket)
+
+
+# -------------------------------------------------------------------------------------------------
+def expected_size(settings, st_path, keys):
+    # Размер ревизии заранее неизвестен, берем размер файла на метке из stcmd list
+    files = settings.listed_files.get(st_path, {})
+    return sum(files[file_name].size for file_name, _ in keys if file_name in files)
+
+
+# -------------------------------------------------------------------------------------------------
+def st_download_task(settings, st_path, dict_history, snapshot, ticket):
+    downloaded = {}
+    cache = settings.blob_cache
+    if cache:
+        # Ревизии, которые уже есть в кэше, не выгружаем
+        for file_name, history in dict_history.items():
+            for item in history:
+                downloaded[(file_name, item.revision)] = cache.lookup(cache.revision_key(settings, item))
+        downloaded = {key: path for key, path in downloaded.items() if path}
+    for version_args, what, chunk in st_plan_checkouts(settings, dict_history, downloaded, snapshot):
+        if len(chunk) < 2:
+            continue  # отдельные файлы выгружаются ниже
+        with settings.scratch.admit(ticket, expected_size(settings, st_path, chunk)):
+            loaded = st_download_batch(settings, st_path, [file_name for file_name, _ in chunk], version_args, what)
+        for file_name, revision in chunk:
+            if file_name in loaded:
+                downloaded[(file_name, revision)] = loaded[file_name]
+
+    # Все, что не удалось выгрузить пакетом, выгружаем по одному файлу
+    for file_name, history in dict_history.items():
+        for item in history:
+            key = (file_name, item.revision)
+            if key not in downloaded:
+                with settings.scratch.admit(ticket, expected_size(settings, st_path, [key])):
+                    downloaded[key] = st_download_one_file(settings, st_path, file_name, item.revision)
+            if cache and downloaded[key] and not downloaded[key].startswith(cache.path):
+                temp_file = downloaded[key]
+                downloaded[key] = cache.store(cache.revision_key(settings, item), temp_file)
+                settings.scratch.release(temp_file)
+    return downloaded
+
+
+# -------------------------------------------------------------------------------------------------
+def move_to_repo(temp_file, root_dir_path, st_path, st_file, keep_source=False):
+    try:
+        # Создаем каталог в папке репозитория
+        os.makedirs(os.path.join(root_dir_path, st_path), exist_ok=True)
+    except BaseException as e:
+        kill_app('mkdir ' + str(e))
+    try:
+        # Переносим файл в каталог репозитория с новым именем (из кэша - копируем)
+        if keep_source:
+            shutil.copyfile(temp_file, os.path.join(root_dir_path, st_path, st_file))
+        else:
+            shutil.move(temp_file, os.path.join(root_dir_path, st_path, st_file))
+        return True
+    except BaseException as e:
+        kill_app('copy ' + str(e))
+
+
+# -------------------------------------------------------------------------------------------------
+def split_tasks(settings, dict_history):
+    """Делит ревизии папки на задачи выгрузки: список (ревизии, звено). Цепочка ревизий файла длиннее
+    ScheduleSplit делится на части, которые выгружаются параллельно, а коммитятся по порядку,
+    звено - (файл, номер части, число частей). Остальные файлы при пакетной выгрузке собираются
+    в задачи не больше ScheduleSplit ревизий, иначе каждый файл - отдельная задача (звено None)"""
+    split = settings.schedule_split
+    tasks = []
+    group = {}
+    group_revisions = 0
+    for file_name, history in dict_history.items():
+        if 0 < split < len(history):
+            parts = [history[i:i + split] for i in range(0, len(history), split)]
+            tasks += [({file_name: part}, (file_name, index, len(parts))) for index, part in enumerate(parts)]
+        elif settings.checkout_batch_size > 1:
+            if group and 0 < split < group_revisions + len(history):
+                tasks.append((group, None))
+                group = {}
+                group_revisions = 0
+            group[file_name] = history
+            group_revisions += len(history)
+        else:
+            tasks.append(({file_name: history}, None))
+    if group:
+        tasks.append((group, None))
+    return tasks
+
+
+# -------------------------------------------------------------------------------------------------
+def is_snapshot_part(chain):
+    # Последние ревизии на метке только в последней части цепочки
+    return chain is None or chain[1] == chain[2] - 1
+
+
+# -------------------------------------------------------------------------------------------------
+def report_schedule(what, costs, workers, running=()):
+    """Ожидаемое время выгрузки при жадном распределении задач (LPT) по потокам: costs - стоимости
+    задач в вызовах stcmd co, running - стоимости задач, которые уже выгружаются (считаются целиком)"""
+    if not costs and not running:
+        return
+    costs = sorted(costs, reverse=True)
+    slots = sorted(list(running)[:workers])
+    slots += [0] * (max(1, min(workers, STCMD_LIMITER.limit)) - len(slots))
+    heapq.heapify(slots)
+    for cost in costs:
+        heapq.heapreplace(slots, slots[0] + cost)
+    stat = METRICS.snapshot()['phases'].get('stcmd_co')
+    call_cost = stat['sum'] / stat['count'] if stat and stat['count'] else 0
+    log('SCHEDULE: {}; {} stcmd co calls, largest task {} calls; expected makespan with {} workers {} calls{}'.format(
+        what, sum(costs) + sum(running), max(costs[:1] + list(running)), len(slots), max(slots),
+        ' (~{})'.format(format_duration(max(slots) * call_cost)) if call_cost else ''))
+
+
+# -------------------------------------------------------------------------------------------------
+class Pipeline:
+    """Выгрузка и запись в git разнесены по стадиям: обход дерева кладет задачи в очередь выгрузки,
+    несколько потоков выгружают, а коммитит один поток. Очереди ограничены, поэтому когда git
+    не успевает, выгрузка и обход дерева ждут, а не копят задачи и выгруженные файлы.
+    Из очереди выгрузки первой берется самая дорогая задача (по числу вызовов stcmd co), чтобы
+    в конце не остался один поток с файлом на сотни ревизий"""
+    def __init__(self, settings, git_repo, workers, queue_size, window):
+        self.settings = settings
+        self.git_repo = git_repo
+        self.downloads = queue.PriorityQueue(maxsize=window)
+        self.commits = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.sequence = 0  # при равной стоимости задачи берутся по порядку постановки
+        self.costs = []
+        self.chain_parts = 0
+        self.running = {}  # поток выгрузки -> стоимость его задачи
+        self.workers = [threading.Thread(target=self.download_worker, name=settings.thread_name('download_{}'.format(i + 1)),
+                                         daemon=True) for i in range(max(1, workers))]
+        self.committer = threading.Thread(target=self.commit_worker, name=settings.thread_name('committer'), daemon=True)
+        for thread in self.workers + [self.committer]:
+            thread.start()
+
+    def schedule(self, cost, task):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        with METRICS.timer('pipeline_download_wait'):
+            self.downloads.put((-cost, sequence, task))
+
+    def put(self, st_path, dict_history):
+        for part, chain in split_tasks(self.settings, dict_history):
+            cost = len(st_plan_checkouts(self.settings, part, snapshot=is_snapshot_part(chain)))
+            with self.lock:
+                self.costs.append(cost)
+                self.chain_parts += chain is not None
+            self.schedule(cost, (st_path, part, chain))
+
+    def download_worker(self):
+        while True:
+            cost, _, task = self.downloads.get()
+            if task is None:
+                break
+            st_path, dict_history, chain = task
+            with self.lock:
+                self.running[threading.get_ident()] = -cost
+            try:
+                downloaded = st_download_revisions(self.settings, st_path, dict_history, is_snapshot_part(chain))
+            except BaseException as e:
+                kill_app(str(e))
+            with self.lock:
+                del self.running[threading.get_ident()]
+            with METRICS.timer('pipeline_commit_wait'):
+                self.commits.put((st_path, dict_history, chain, downloaded))
+
+    def commit(self, dict_history, downloaded):
+        absent = []
+        for file_name in sorted(dict_history.keys()):
+            for item in dict_history[file_name]:
+                temp_file = downloaded[(file_name, item.revision)]
+                if temp_file:
+                    git_commit_changeset(self.settings, self.git_repo, [(item, temp_file)])
+                else:
+                    absent.append(item)
+        mark_absent(self.settings, absent)
+
+    def commit_worker(self):
+        next_part = {}  # (папка, файл) -> номер следующей части цепочки
+        held = {}  # ((папка, файл), номер части) -> выгруженная часть, которой рано коммититься
+        while True:
+            with METRICS.timer('pipeline_committer_idle'), self.settings.scratch.committer_idle():
+                task = self.commits.get()
+            if task is None:
+                break
+            st_path, dict_history, chain, downloaded = task
+            try:
+                if chain is None:
+                    self.commit(dict_history, downloaded)
+                    continue
+                key = (st_path, chain[0])
+                held[(key, chain[1])] = (dict_history, downloaded)
+                while (key, next_part.get(key, 0)) in held:
+                    self.commit(*held.pop((key, next_part.get(key, 0))))
+                    next_part[key] = next_part.get(key, 0) + 1
+            except BaseException as e:
+                kill_app(str(e))
+
+    def report_schedule(self):
+        """Задачи поступают по мере обхода дерева, поэтому все они известны только после обхода:
+        тогда оценивается оставшаяся выгрузка - задачи в очереди и те, что уже выгружаются"""
+        with self.downloads.mutex:
+            queued = [-cost for cost, _, task in self.downloads.queue if task is not None]
+        with self.lock:
+            running = list(self.running.values())
+            total = len(self.costs)
+            chain_parts = self.chain_parts
+        report_schedule('crawl finished, {} download tasks ({} parts of split revision chains), '
+                        '{} queued, {} running'.format(total, chain_parts, len(queued), len(running)),
+                        queued, len(self.workers), running)
+
+    def close(self):
+        # Дожидаемся, пока все, что уже в очередях, будет выгружено и закоммичено
+        for _ in self.workers:
+            self.schedule(float('-inf'), None)
+        for thread in self.workers:
+            thread.join()
+        self.commits.put(None)
+        self.committer.join()
+
+
+# -------------------------------------------------------------------------------------------------
+def st_parse_history(st_path, lines):
+    """Разбирает вывод stcmd hist по мере чтения, выдает пары (файл, ревизии файла по возрастанию)"""
+    file_name = None
+    revisions = []
+    revision = author = date = comment = None
     comment_begin = False
-    for line in st_list:
+    for line in lines:
         line = line.strip()
-        # log(line)
         if line.startswith('History for:'):  # начало блока информации о файле
-            name = line.rsplit('History for: ', 1)[1]  # последнее слово с конца - название файла
-            history_item[KEY_FILENAME] = name
+            file_name = sys.intern(line.rsplit('History for: ', 1)[1])  # последнее слово с конца - название файла
 
         elif line.startswith('Revision:'):
-            revision = line.split(' ', 2)[1]  # второая цифра от начала - номер ревизии
-            history_item[KEY_REVISION] = int(revision)
+            revision = int(line.split(' ', 2)[1])  # второая цифра от начала - номер ревизии
 
         elif line.startswith('Author:'):
             author_date = line.split(' Date: ', 2)
-            author = author_date[0]
+            author = sys.intern(author_date[0].replace('Author: ', '', 1))  # авторов немного, храним по одному
             date = author_date[1]
-            history_item[KEY_AUTHOR] = author.replace('Author: ', '', 1)
-            history_item[KEY_DATE] = date
             comment_begin = True
 
-        elif line == '----------------------------':
-            # конец блока информации о ревизии -
-            # ревизия уже есть в элементе, значит
-            # начало блока ревизии уже было
-            if KEY_REVISION in history_item:
-                history_list.append(history_item)
-                history_item = {KEY_PATH: st_path, KEY_FILENAME: history_item[KEY_FILENAME]}
-                comment_begin = False
-
-        elif line == '=============================================================================':
-            # конец блока информации о файле
-            history_list.append(history_item)
-            history_item = {KEY_PATH: st_path, KEY_FILENAME: history_item[KEY_FILENAME]}
+        elif line == '----------------------------' or \
+                line == '=============================================================================':
+            # конец блока информации о ревизии или о файле -
+            # если ревизия уже есть, значит начало блока ревизии уже было
+            if revision is not None:
+                revisions.append(HistoryItem(st_path, file_name, revision, author, date, comment))
+            revision = author = date = comment = None
             comment_begin = False
+            if line.startswith('='):
+                yield file_name, sorted(revisions, key=lambda item: item.revision)
+                revisions = []
 
         elif comment_begin:
-            if KEY_COMMENT in history_item:
-                history_item[KEY_COMMENT] += line
-            else:
-                history_item[KEY_COMMENT] = line
-    # сортировка по путь - файл - ревизия
-    list_return = sorted(history_list, key=lambda tup: (tup[KEY_PATH], tup[KEY_FILENAME], tup[KEY_REVISION]))
-    # группировка по названию файла
-    dict_return = {}
-    for item in list_return:
-        file_name = item[KEY_FILENAME]
-        history_items_of_file = dict_return[file_name] if file_name in dict_return else []
-        history_items_of_file.append(item)
-        dict_return.update({file_name: history_items_of_file})
-
-    log('List of history items for {}: {}'.format(st_path, dict_return))
+            comment = line if comment is None else comment + line
+
+
+# -------------------------------------------------------------------------------------------------
+def st_moved_files(settings, st_path):
+    """При синхронизации - файлы папки, которые изменились со времени прошлого переноса (по размеру
+    и времени изменения из stcmd list), None - неизвестно, нужна история всей папки"""
+    previous = settings.journal.get_folder_state(st_path) if settings.journal and settings.sync_time else None
+    current = settings.listed_files.get(st_path)
+    if previous is None or current is None:
+        return None
+    return [file_name for file_name, listed in current.items()
+            if listed.date is None or previous.get(file_name) != [listed.size, listed.date]]
+
+
+# -------------------------------------------------------------------------------------------------
+def st_list_history(settings, st_path):
+    if settings.journal and not settings.sync_time:
+        dict_return = settings.journal.get_listing(st_path, COMMAND_HIST)
+        if dict_return is not None:
+            log('List of history items for {} taken from journal'.format(st_path))
+            return {file_name: [HistoryItem(*item) for item in history] for file_name, history in dict_return.items()}
+    moved = st_moved_files(settings, st_path)
+    if moved is not None and len(moved) <= max(1, settings.checkout_batch_size):
+        # Синхронизация: историю запрашиваем только у изменившихся файлов
+        METRICS.count('sync_unchanged_files', len(settings.listed_files[st_path]) - len(moved))
+        if not moved:
+            log('Folder {} not changed since previous run'.format(st_path), level=LOG_DEBUG)
+            return {}
+        try:
+            dict_return = dict(settings.broker.hist(st_path, moved))
+        except StarteamRetry as e:
+            return retry(str(e), st_list_history, settings, st_path)
+        log('List of history items for {} changed files in {}: {} revisions'.format(
+            len(moved), st_path, sum(len(history) for history in dict_return.values())))
+        return {file_name: dict_return[file_name] for file_name in sorted(dict_return.keys()) if dict_return[file_name]}
+    dict_return = settings.response_cache.get(settings, st_path, COMMAND_HIST) if settings.response_cache else None
+    if dict_return is not None:
+        dict_return = {file_name: [HistoryItem(*item) for item in history] for file_name, history in dict_return.items()}
+    else:
+        dict_return = {}
+        try:
+            for file_name, history in settings.broker.hist(st_path):
+                if history:
+                    dict_return.setdefault(file_name, []).extend(history)
+        except StarteamRetry as e:
+            return retry(str(e), st_list_history, settings, st_path)
+        # сортировка по файлу
+        dict_return = {file_name: dict_return[file_name] for file_name in sorted(dict_return.keys())}
+        if settings.response_cache:
+            settings.response_cache.set(settings, st_path, COMMAND_HIST, dict_return)
+
+    log('List of history items for {}: {} files, {} revisions'.format(
+        st_path, len(dict_return), sum(len(history) for history in dict_return.values())))
+    METRICS.count('history_files', len(dict_return))
+    METRICS.count('history_revisions', sum(len(history) for history in dict_return.values()))
+    if settings.journal and not settings.sync_time:
+        # История на время синхронизации (тем более только изменившихся файлов) - не история на метке,
+        # --resume не должен принять ее за полную. Прерванная синхронизация повторяется с --sync
+        settings.journal.set_listing(st_path, COMMAND_HIST, dict_return)
     return dict_return
 
 
+# -------------------------------------------------------------------------------------------------
+def st_parse_list_files(lines):
+    """Файлы папки из вывода stcmd list: файл -> (размер, время изменения или None)"""
+    files = {}
+    for line in lines:
+        match = LIST_FILE.match(line) if line.strip() and is_file_item(line) else None
+        if match:
+            files[match.group(3)] = (int(match.group(1)), match.group(2))
+    return files
+
+
 # -------------------------------------------------------------------------------------------------
 def st_list_dirs(settings, st_path, excluded_folders=None):
-    st_list = st_list_anything(settings, COMMAND_LIST, '-cf', 'FOLDERS', st_path)
-    if not st_list:
-        return []
-    list_dirs = []
+    if settings.journal and not settings.sync_time:
+        list_return = settings.journal.get_listing(st_path, COMMAND_LIST)
+        list_files = settings.journal.get_listing(st_path, LISTING_FILES)
+        if list_return is not None and list_files is not None:
+            log('List of subfolders for {} taken from journal'.format(st_path))
+            settings.listed_files[st_path] = {file_name: ListedFile(*item) for file_name, item in list_files.items()}
+            return list_return
+    list_dirs = settings.response_cache.get(settings, st_path, COMMAND_LIST) if settings.response_cache else None
+    list_files = settings.response_cache.get(settings, st_path, LISTING_FILES) if settings.response_cache else None
+    if list_dirs is None or list_files is None:
+        st_list = settings.broker.list(st_path)
+        list_dirs = sorted(item.strip().replace('\\', '') for item in st_list if not is_file_item(item))
+        list_files = st_parse_list_files(st_list)
+        if settings.response_cache:
+            settings.response_cache.set(settings, st_path, COMMAND_LIST, list_dirs)
+            settings.response_cache.set(settings, st_path, LISTING_FILES, list_files)
+    settings.listed_files[st_path] = {file_name: ListedFile(*item) for file_name, item in list_files.items()}
     list_return = []
-    for item in st_list:
-        if not is_file_item(item):
-            list_dirs.append(item.strip().replace('\\', ''))
-    list_dirs.sort()
 
     if excluded_folders:
         excluded_folders_lower = [excluded_folder.lower() for excluded_folder in excluded_folders]
@@ -569,64 +2738,771 @@ def st_list_dirs(settings, st_path, excluded_folders=None):
                 list_return.append(item)
     else:
         list_return = list_dirs
+    for item in set(list_dirs) - set(list_return):
+        settings.broker.forget(st_path + item + '/', subtree=True)  # исключенные папки никто не запросит
 
     log('List of subfolders for {}: {}'.format(st_path, list_return))
+    if settings.journal and not settings.sync_time:
+        settings.journal.set_listing(st_path, COMMAND_LIST, list_return)
+        settings.journal.set_listing(st_path, LISTING_FILES, list_files)
     return list_return
 
 
 # -------------------------------------------------------------------------------------------------
-def st_process_dir(settings, git_repo, futures, st_path):
+def st_process_dir(settings, st_path, histories=None):
     dict_history = st_list_history(settings, st_path)
-    for file_name in dict_history.keys():
-        list_history = dict_history[file_name]
-        futures.append(EXECUTOR.submit(
-            st_download_files_and_commit_to_git,
-            settings, git_repo, list_history, st_path))
+    settings.broker.forget(st_path)  # история папки из загрузки поддерева больше не нужна
+    if settings.journal:
+        # Уже закоммиченные ревизии пропускаем
+        committed = settings.journal.committed_revisions(st_path)
+        if committed:
+            dict_history = {file_name: [item for item in history
+                                        if (file_name, item.revision) not in committed]
+                            for file_name, history in dict_history.items()}
+            dict_history = {file_name: history for file_name, history in dict_history.items() if history}
+            log('Skipped {} already committed or absent revisions in {}'.format(len(committed), st_path))
+    if not dict_history:
+        return
+    settings.progress.count('revisions_found', sum(len(history) for history in dict_history.values()))
+    if histories is not None:
+        # Наборы изменений строятся после обхода всего дерева
+        histories[st_path] = dict_history
+    else:
+        # Пакетная выгрузка: папка делится на задачи не больше ScheduleSplit ревизий, иначе по файлам
+        settings.pipeline.put(st_path, dict_history)
 
 
 # -------------------------------------------------------------------------------------------------
-def starteam_run(settings, git_repo, futures, st_path, excluded_folders=None):
-    st_folders = st_list_dirs(settings, st_path, excluded_folders)
-    try:
+def starteam_run(settings, st_path, excluded_folders=None, histories=None):
+    # Списки папок и истории загружаются параллельно, но не более чем settings.list_concurrency
+    # вызовов stcmd list/hist одновременно. Выгрузка папки отправляется в settings.pipeline сразу
+    # после разбора ее истории, так что обход дерева и выгрузка идут одновременно
+    crawler = concurrent.futures.ThreadPoolExecutor(max_workers=settings.list_concurrency,
+                                                    thread_name_prefix=settings.thread_name('crawler'))
+    crawl_futures = []
+    crawl_lock = threading.Lock()
+
+    def submit(func, *args):
+        with crawl_lock:
+            crawl_futures.append(crawler.submit(func, *args))
+
+    def crawl(path, excluded):
+        st_folders = st_list_dirs(settings, path, excluded)
+        if path != st_path:
+            # История папки - после ее списка файлов, размеры из него нужны при выгрузке
+            submit(st_process_dir, settings, path, histories)
+        if path == st_path and settings.shard:
+            # Папки верхнего уровня делятся между шардами по кругу в порядке сортировки
+            shard_index, shard_count = settings.shard
+            st_folders = st_folders[shard_index - 1::shard_count]
+            log('Shard {}/{} folders: {}'.format(shard_index, shard_count, st_folders))
         for st_folder in st_folders:
-            next_st_path = st_path + st_folder + '/'
-            st_process_dir(settings, git_repo, futures, next_st_path)
+            submit(crawl, path + st_folder + '/', None)  # рекурсия
+
+    submit(crawl, st_path, excluded_folders)
+    # Задачи обхода порождают новые задачи, поэтому ждем, пока не перестанут появляться новые
+    checked = 0
+    while True:
+        with crawl_lock:
+            pending = crawl_futures[checked:]
+            checked = len(crawl_futures)
+        if not pending:
+            break
+        for future in pending:
+            try:
+                future.result()
+            except BaseException as e:
+                kill_app('Exception {}'.format(e))
+    crawler.shutdown()
+    settings.broker.forget(st_path, subtree=True)
 
-        for st_folder in st_folders:
-            next_st_path = st_path + st_folder + '/'
-            starteam_run(settings, git_repo, futures, next_st_path)  # рекурсия
-    except BaseException as e:
-        kill_app('Exception {}'.format(e))
+
+# -------------------------------------------------------------------------------------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description='StarTeam to Git migration')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue interrupted migration using journal {}'.format(filename('db')))
+    parser.add_argument('--sync', action='store_true',
+                        help='append revisions made in StarTeam since the previous run to the migrated repository')
+    parser.add_argument('--plan', action='store_true',
+                        help='only crawl folders and history, print totals and estimated migration time')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare {} branches with the label snapshot in StarTeam, write {}'.format(
+                            PATH_GIT_REPO, filename('verify.txt')))
+    parser.add_argument('--offline', action='store_true',
+                        help='take folder lists and histories only from the response cache, do not call stcmd list/hist')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='migrate only every N-th top-level folder starting from I-th into {}'.format(
+                            shard_name(PATH_GIT_REPO, ('I', 'N'))))
+    parser.add_argument('--merge', nargs='+', metavar='SHARD_REPO',
+                        help='merge migrated shard repositories (paths or URLs) into {} by StarTeam time'.format(
+                            PATH_GIT_REPO))
+    parser.add_argument('--jobs', metavar='JOBS_INI',
+                        help='migrate several projects listed in JOBS_INI concurrently '
+                             'under one StarTeam concurrency budget')
+    args = parser.parse_args()
+    if args.jobs and (args.plan or args.verify or args.shard or args.merge):
+        parser.error('--jobs cannot be combined with --plan, --verify, --shard or --merge')
+    return args
 
 
 # -------------------------------------------------------------------------------------------------
-def run():
-    log('=' * 120)
-    log('STARTED')
+def parse_shard(text):
+    try:
+        shard_index, shard_count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected I/N, for example 2/4')
+    if not 1 <= shard_index <= shard_count:
+        raise argparse.ArgumentTypeError('shard number must be from 1 to {}'.format(shard_count))
+    return shard_index, shard_count
 
-    global_settings = GlobalSettings()
-    cleaned = clean(PATH_GIT_REPO) and clean(PATH_TEMP)
-    not_inited = not global_settings.was_success() or not cleaned or not ask_starteam_password(global_settings)
-    git_repo = git_init(global_settings.git_url)
-    if not_inited or not git_repo:
-        return
 
-    futures = []
-    starteam_run(global_settings, git_repo, futures, '',
-                 ['BLL', 'BLL_Client', 'Doc', '_Personal', 'DBOReports', 'BUILD', 'Scripts',
-                  '_TZ', '_ProjectData', '_ProjectData2', 'Config', 'DLL'])
-                  
-    # '###MBC41', 'SETUP', 'BASE', 'RT_Tpl', 'WWW', 'RTF',  'XSD', 'History',
-    # 'WWW_react', '### Native ReactUI', 'EXTERNAL', 'MIG_UTIL', #'BLS'
+# -------------------------------------------------------------------------------------------------
+def use_shard_paths(settings, shard):
+    # У каждого шарда свои репозиторий, временный каталог, журнал, кэши и лог,
+    # поэтому несколько шардов можно запускать из одного каталога
+    settings.shard = shard
+    settings.repo_path = shard_name(settings.repo_path, shard)
+    settings.temp_path = shard_name(settings.temp_path, shard)
+    settings.verify_path = shard_name(settings.verify_path, shard)
+    settings.blob_cache_path = shard_name(settings.blob_cache_path, shard)
+    settings.metrics_file = shard_name(settings.metrics_file, shard)
+    settings.response_cache_path = shard_name(settings.response_cache_path, shard)
+
 
-    done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
-    for future in concurrent.futures.as_completed(done):
+# -------------------------------------------------------------------------------------------------
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h {:02d}m {:02d}s'.format(hours, minutes, seconds)
+
+
+# -------------------------------------------------------------------------------------------------
+def saved_phases(settings):
+    """Длительности этапов из метрик прошлого запуска (MetricsFile в формате JSON), если они есть"""
+    if settings.metrics_file and settings.metrics_file.endswith('.json') and os.path.exists(settings.metrics_file):
         try:
-            future.result()
+            with open(settings.metrics_file, encoding='utf-8') as f:
+                return json.load(f)['phases']
+        except BaseException as e:
+            log('Can not read metrics from "{}" ({})'.format(settings.metrics_file, e), level=LOG_WARNING)
+    return {}
+
+
+# -------------------------------------------------------------------------------------------------
+def measured_commit_cost(settings):
+    # Стоимость коммита берем из метрик прошлого запуска, если они есть
+    phases = saved_phases(settings)
+    cost = sum(phases[phase]['sum'] / phases[phase]['count']
+               for phase in ('git_index_add', 'git_commit', 'git_store_blob')
+               if phase in phases and phases[phase]['count'])
+    if cost > 0:
+        return cost, settings.metrics_file
+    return settings.plan_commit_cost, 'PlanCommitCost'
+
+
+# -------------------------------------------------------------------------------------------------
+def estimated_checkout_cost(settings, checkout_calls, expected_bytes):
+    """Стоимость одного вызова stcmd co без пробных выгрузок: из метрик прошлого запуска, иначе
+    запуск stcmd и вход на сервер (по вызовам list/hist) плюс передача ожидаемого объема
+    (размеры из stcmd list) со скоростью, с которой сервер отдавал историю"""
+    saved = saved_phases(settings).get('stcmd_co')
+    if saved and saved['count']:
+        return saved['sum'] / saved['count'], settings.metrics_file
+    snapshot = METRICS.snapshot()
+    startup = snapshot['phases'].get('stcmd_startup')
+    hist = snapshot['phases'].get('stcmd_' + COMMAND_HIST)
+    startup_cost = startup['sum'] / startup['count'] if startup and startup['count'] else 0
+    cost = startup_cost
+    transfer_seconds = hist['sum'] - hist['count'] * startup_cost if hist else 0
+    hist_bytes = snapshot['counters'].get('stcmd_{}_bytes'.format(COMMAND_HIST), 0)
+    if transfer_seconds > 0 and hist_bytes and checkout_calls:
+        cost += expected_bytes / checkout_calls / (hist_bytes / transfer_seconds)
+    return cost, 'list/hist timings, {} MB by list sizes'.format(expected_bytes // (1024 * 1024))
+
+
+# -------------------------------------------------------------------------------------------------
+def sample_checkouts(settings, histories, checkouts):
+    # Только если задан PlanSamples: несколько настоящих выгрузок из самых больших папок,
+    # чтобы измерить стоимость вызова stcmd co
+    samples = []
+    for st_path in sorted(checkouts.keys(), key=lambda path: -len(checkouts[path]))[:settings.plan_samples]:
+        version_args, what, chunk = checkouts[st_path][0]
+        start = time.time()
+        full_temp_path = settings.broker.checkout(st_path, [file_name for file_name, _ in chunk], version_args, what)
+        samples.append(time.time() - start)
+        clean(scratch_dir(settings, full_temp_path), write_log=False)
+    return samples
+
+
+# -------------------------------------------------------------------------------------------------
+def plan_report(settings, histories, discovery_seconds):
+    items = [item for dict_history in histories.values() for history in dict_history.values() for item in history]
+    files = sum(len(dict_history) for dict_history in histories.values())
+    authors = set(item.author for item in items)
+    timestamps = [st_time_to_timestamp(item.date) for item in items]
+    top_folders = collections.Counter(item.path.split('/', 1)[0] for item in items)
+    checkouts = {st_path: st_plan_checkouts(settings, dict_history) for st_path, dict_history in histories.items()}
+    checkout_calls = sum(len(folder_checkouts) for folder_checkouts in checkouts.values())
+    commits = len(build_changesets(histories, settings.changeset_window)) if settings.changeset_window > 0 \
+        else len(items)
+
+    list_stat = METRICS.snapshot()['phases']
+    list_calls = sum(list_stat[phase]['count'] for phase in ('stcmd_list', 'stcmd_hist') if phase in list_stat)
+    list_seconds = sum(list_stat[phase]['sum'] for phase in ('stcmd_list', 'stcmd_hist') if phase in list_stat)
+    list_cost = list_seconds / list_calls if list_calls else 0
+    expected_bytes = sum(expected_size(settings, st_path, [(file_name, item.revision) for item in history])
+                         for st_path, dict_history in histories.items() for file_name, history in dict_history.items())
+    samples = sample_checkouts(settings, histories, checkouts) if settings.plan_samples > 0 else []
+    if samples:
+        checkout_cost = sum(samples) / len(samples)
+        checkout_cost_source = '{} sample checkouts, PlanSamples = {}'.format(len(samples), settings.plan_samples)
+    else:
+        checkout_cost, checkout_cost_source = estimated_checkout_cost(settings, checkout_calls, expected_bytes)
+    commit_cost, commit_cost_source = measured_commit_cost(settings)
+    # Выгрузка идет параллельно, коммиты - последовательно; этапы перекрываются
+    download_seconds = checkout_calls * checkout_cost / max(1, settings.stcmd_concurrency)
+    commit_seconds = commits * commit_cost
+    total_seconds = discovery_seconds + max(download_seconds, commit_seconds)
+
+    lines = ['MIGRATION PLAN for {}/{} label {}:'.format(settings.starteam_project, settings.starteam_view,
+                                                          settings.view_label),
+             '\tfolders with history: {}'.format(len(histories)),
+             '\tfiles: {}'.format(files),
+             '\trevisions: {}'.format(len(items)),
+             '\tauthors: {}'.format(len(authors)),
+             '\tdates: {} .. {}'.format(datetime.fromtimestamp(min(timestamps)) if timestamps else '-',
+                                        datetime.fromtimestamp(max(timestamps)) if timestamps else '-'),
+             '\tstcmd co calls: {} (CheckoutBatchSize = {}), expected download {} MB'.format(
+                 checkout_calls, settings.checkout_batch_size, expected_bytes // (1024 * 1024)),
+             '\tcommits: {} (ChangesetWindow = {})'.format(commits, settings.changeset_window),
+             '\trevisions per top-level folder:']
+    lines += ['\t\t{:>10} {}'.format(count, folder) for folder, count in top_folders.most_common()]
+    lines += ['\tmeasured: discovery {} ({} list/hist calls, {:.2f}s each), stcmd co {:.2f}s ({}), '
+              'commit {:.3f}s ({})'.format(format_duration(discovery_seconds), list_calls, list_cost,
+                                           checkout_cost, checkout_cost_source, commit_cost, commit_cost_source),
+              '\testimated download {} with {} concurrent stcmd, commit {}'.format(
+                  format_duration(download_seconds), settings.stcmd_concurrency, format_duration(commit_seconds)),
+              '\tESTIMATED WALL-CLOCK TIME: {}'.format(format_duration(total_seconds))]
+    log('\n'.join(lines))
+
+
+# -------------------------------------------------------------------------------------------------
+def run_plan(settings):
+    # Только обход дерева и разбор истории: ничего не выгружается (кроме пробных выгрузок PlanSamples)
+    # и не коммитится
+    settings.scratch = ScratchArea(settings.temp_path, 0)
+    histories = {}
+    start = time.time()
+    starteam_run(settings, '', settings.excluded_folders, histories)
+    plan_report(settings, histories, time.time() - start)
+    settings.broker.report()
+
+
+# -------------------------------------------------------------------------------------------------
+def view_name(path, index):
+    # Журнал первого вида - st2git.db, остальных - st2git.view2.db и т.д.
+    if index <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.view{}{}'.format(root, index, ext)
+
+
+# -------------------------------------------------------------------------------------------------
+def migrate_view(settings, git_repo, journal_file_name, view, label, branch):
+    log('MIGRATING VIEW {} label {} into branch {}'.format(view, label, branch))
+    settings.starteam_view = view
+    settings.view_label = label
+    settings.listed_files = {}
+    settings.journal = Journal(journal_file_name)
+    if not settings.journal.check_identity('{}/{}/{}'.format(settings.starteam_project, view, label)):
+        log('ERROR: journal {} belongs to another project/view/label'.format(journal_file_name), level=LOG_ERROR)
+        settings.journal.close()
+        return False
+    if settings.git_backend == GIT_BACKEND_FAST_IMPORT:
+        git_repo = GitFastImport(git_repo, settings.journal, settings.fast_import_checkpoint, branch)
+    else:
+        git_switch_branch(git_repo, branch)
+    if settings.blob_cache:
+        settings.blob_cache.start_branch()
+    if settings.lfs:
+        settings.lfs.start_branch(git_repo.git_repo if isinstance(git_repo, GitFastImport) else git_repo, branch)
+    if settings.sync_time:
+        log('Syncing changes since {}'.format(settings.journal.get_value('synced') or 'migration'))
+
+    if settings.changeset_window > 0:
+        # Наборы изменений коммитятся в порядке времени, поэтому сначала обходим все дерево
+        histories = {}
+        starteam_run(settings, '', settings.excluded_folders, histories)
+        try:
+            st_commit_changesets(settings, git_repo, histories)
         except Exception as exc:
-            log('Thread generated an exception: {}'.format(exc))
+            # История ветки неполная: ни состояние папок, ни время синхронизации не записываем,
+            # чтобы следующий запуск (--resume или --sync) продолжил с того же места
+            log('ERROR: changeset commit failed, view {} is not complete: {}'.format(view, exc), level=LOG_ERROR)
+            if isinstance(git_repo, GitFastImport):
+                git_repo.close()
+            settings.journal.close()
+            return False
+    else:
+        settings.pipeline = Pipeline(settings, git_repo, settings.download_workers, settings.pipeline_queue,
+                                     settings.schedule_window)
+        starteam_run(settings, '', settings.excluded_folders)
+        settings.pipeline.report_schedule()
+        settings.pipeline.close()
+
+    if isinstance(git_repo, GitFastImport):
+        git_repo.close()
+    # Следующая синхронизация запросит историю только у файлов, изменившихся с этого момента
+    settings.journal.set_folder_states({st_path: {file_name: list(listed) for file_name, listed in files.items()}
+                                        for st_path, files in settings.listed_files.items()})
+    if settings.sync_time:
+        settings.journal.set_value('synced', settings.sync_time)
+    settings.journal.close()
+    return True
+
+
+# -------------------------------------------------------------------------------------------------
+def git_tree_files(git_repo, ref):
+    """Файлы дерева коммита без выгрузки в рабочий каталог: путь -> sha1 блоба"""
+    files = {}
+    for entry in git_repo.git.ls_tree('-r', '-z', '--full-tree', ref).split('\0'):
+        if entry:
+            info, path = entry.split('\t', 1)
+            _, kind, blob_sha = info.split(' ')
+            if kind == 'blob':
+                files[path] = blob_sha
+    return files
+
+
+# -------------------------------------------------------------------------------------------------
+def git_lfs_oids(git_repo, blob_shas):
+    """Для блобов, которые являются указателями LFS: sha1 блоба -> sha256 содержимого"""
+    check = subprocess.run(['git', 'cat-file', '--batch-check'], cwd=git_repo.working_dir, stdout=subprocess.PIPE,
+                           input=''.join(blob_sha + '\n' for blob_sha in blob_shas).encode())
+    # Указатели маленькие, большие блобы не читаем
+    small = [line.split()[0] for line in check.stdout.decode().splitlines()
+             if len(line.split()) == 3 and int(line.split()[2]) < 1024]
+    batch = subprocess.run(['git', 'cat-file', '--batch'], cwd=git_repo.working_dir, stdout=subprocess.PIPE,
+                           input=b''.join(blob_sha.encode() + b'\n' for blob_sha in small))
+    oids = {}
+    data = batch.stdout
+    position = 0
+    while position < len(data):
+        header_end = data.index(b'\n', position)
+        blob_sha, _, size = data[position:header_end].decode().split()
+        content = data[header_end + 1:header_end + 1 + int(size)]
+        position = header_end + 1 + int(size) + 1
+        match = re.match(rb'version https://git-lfs\.github\.com/spec/v1\noid sha256:([0-9a-f]{64})\n', content)
+        if match:
+            oids[blob_sha] = match.group(1).decode()
+    return oids
 
-    log('FINISHED')
+
+# -------------------------------------------------------------------------------------------------
+def verify_view(settings, git_repo, hash_cache, verify_dir, branch):
+    """Сравнивает снимок вида на метке с деревом ветки. Папки верхнего уровня выгружаются
+    параллельно в постоянный каталог verify_dir, файлы хэшируются в отдельном пуле потоков.
+    Возвращает список (результат, путь)"""
+    try:
+        git_files = git_tree_files(git_repo, branch)
+    except Exception as exc:
+        log('ERROR: can not read branch {} ({})'.format(branch, exc), level=LOG_ERROR)
+        return [('NO BRANCH', branch)]
+    git_files.pop(LfsStore.ATTRIBUTES, None)
+    identity = '{}/{}/{}'.format(settings.starteam_project, settings.starteam_view, ' '.join(settings.configuration()))
+    if hash_cache.get_value(verify_dir) != identity:
+        clean(verify_dir)  # там выгружена другая метка
+        hash_cache.set_value(verify_dir, identity)
+
+    st_folders = st_list_dirs(settings, '', settings.excluded_folders)
+    if settings.shard:
+        shard_index, shard_count = settings.shard
+        st_folders = st_folders[shard_index - 1::shard_count]
+    hasher = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 4,
+                                                   thread_name_prefix=settings.thread_name('hash'))
+
+    def check_folder(st_folder):
+        target = os.path.join(verify_dir, st_folder)
+        settings.broker.checkout(st_folder + '/', [], settings.configuration(),
+                                 'SNAPSHOT {}'.format(' '.join(settings.configuration())), target, force=False)
+        futures = []
+        for d, dirs, files in os.walk(target):
+            dirs[:] = [dir_name for dir_name in dirs if dir_name != '.sbas']  # служебный каталог StarTeam
+            futures += [(os.path.join(d, file_name), hasher.submit(hash_cache.hashes, os.path.join(d, file_name)))
+                        for file_name in files]
+        log('Verify: {} files of {} loaded'.format(len(futures), st_folder))
+        return futures
+
+    results = []
+    lfs_candidates = []
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, settings.download_workers),
+                                               thread_name_prefix=settings.thread_name('verify')) as checkouts:
+        for folder_future in [checkouts.submit(check_folder, st_folder) for st_folder in st_folders]:
+            for file_path, hash_future in folder_future.result():
+                repo_path = os.path.relpath(file_path, verify_dir).replace(os.sep, '/')
+                sha1, sha256 = hash_future.result()
+                seen.add(repo_path)
+                if repo_path not in git_files:
+                    results.append(('MISSING IN GIT', repo_path))
+                elif git_files[repo_path] != sha1:
+                    lfs_candidates.append((repo_path, git_files[repo_path], sha256))
+    hasher.shutdown()
+    # Содержимое файлов в LFS сравниваем с oid указателя
+    oids = git_lfs_oids(git_repo, set(blob_sha for _, blob_sha, _ in lfs_candidates)) if lfs_candidates else {}
+    results += [('DIFFERENT', repo_path) for repo_path, blob_sha, sha256 in lfs_candidates
+                if oids.get(blob_sha) != sha256]
+    results += [('ONLY IN GIT', repo_path) for repo_path in git_files if repo_path not in seen]
+    log('Verify {}: {} files in StarTeam, {} in git, {} mismatches'.format(
+        branch, len(seen), len(git_files), len(results)))
+    return sorted(results, key=lambda result: (result[1], result[0]))
+
+
+# -------------------------------------------------------------------------------------------------
+def run_verify(settings, git_repo):
+    start = time.time()
+    hash_cache = HashCache(shard_name(settings.file_name('hashes.db'), settings.shard))
+    report_file_name = shard_name(settings.file_name('verify.txt'), settings.shard)
+    mismatches = 0
+    with open(report_file_name, mode='w', encoding='utf-8') as report:
+        for index, (view, label, branch) in enumerate(settings.views, 1):
+            settings.starteam_view = view
+            settings.view_label = label
+            log('VERIFYING branch {} against view {} label {}'.format(branch, view, label))
+            for result, repo_path in verify_view(settings, git_repo, hash_cache, view_name(settings.verify_path, index),
+                                                    branch):
+                report.write('{}\t{}\t{}\n'.format(result, branch, repo_path))
+                if mismatches < 20:
+                    log('\t{}: {} {}'.format(result, branch, repo_path), level=LOG_WARNING)
+                mismatches += 1
+    log('VERIFY {} in {}: {} mismatches (see {}), {} files hashed ({} MB), {} taken from hash cache'.format(
+        'FAILED' if mismatches else 'PASSED', format_duration(time.time() - start), mismatches, report_file_name,
+        hash_cache.stats['hashed'], hash_cache.stats['hashed_bytes'] // (1024 * 1024), hash_cache.stats['hits']),
+        level=LOG_ERROR if mismatches else LOG_INFO)
+    hash_cache.close()
+
+
+# -------------------------------------------------------------------------------------------------
+def configure_limiter(settings):
+    STCMD_LIMITER.configure(settings.stcmd_concurrency,
+                            settings.stcmd_min_concurrency,
+                            settings.stcmd_max_concurrency,
+                            settings.retry_limit,
+                            settings.retry_delay,
+                            settings.retry_max_delay)
+
+
+# -------------------------------------------------------------------------------------------------
+def close_response_cache(settings):
+    if settings.response_cache:
+        settings.response_cache.report()
+        settings.response_cache.close()
+
+
+# -------------------------------------------------------------------------------------------------
+def migrate_project(settings, args):
+    """Перенос одного проекта (всех его видов) в settings.repo_path. Настройки уже прочитаны,
+    пароль введен, ограничитель stcmd настроен"""
+    journal_file_name = shard_name(settings.file_name('db'), settings.shard)
+    resume = (args.resume or args.sync) and os.path.exists(settings.repo_path) and os.path.exists(journal_file_name)
+    if args.sync and not resume:
+        log('ERROR: NOTHING TO SYNC, migrate the view first', level=LOG_ERROR)
+        return False
+    if args.sync:
+        # Синхронизация - это продолжение миграции, но по текущему состоянию вида вместо метки:
+        # журнал отсекает уже закоммиченные ревизии, выгружаются и коммитятся только новые
+        settings.sync_time = datetime.now().strftime('%d.%m.%y %H:%M:%S')
+    if args.resume and not resume:
+        log('NOTHING TO RESUME, starting from scratch')
+    if resume:
+        cleaned = clean(settings.temp_path)
+    else:
+        cleaned = clean(settings.repo_path) and clean(settings.temp_path)
+        # сам журнал, журналы остальных видов и файлы WAL
+        for journal_file in glob.glob(journal_file_name + '*') + \
+                glob.glob(os.path.splitext(journal_file_name)[0] + '.view*'):
+            os.remove(journal_file)
+    if not cleaned:
+        return False
+    git_repo = git_open(settings.repo_path) if resume else git_init(settings.repo_path, settings.git_url)
+    if not git_repo:
+        return False
+    if settings.blob_cache_size > 0:
+        settings.blob_cache = BlobCache(settings.blob_cache_path, settings.blob_cache_size)
+    elif len(settings.views) > 1:
+        # Общие для видов ревизии выгружаются один раз только через кэш, поэтому без кэша не обойтись
+        log('BlobCacheSize = 0, using blob cache without size limit for {} views'.format(
+            len(settings.views)), level=LOG_WARNING)
+        settings.blob_cache = BlobCache(settings.blob_cache_path, 0)
+    settings.scratch = ScratchArea(settings.temp_path, settings.scratch_quota)
+    if settings.lfs_extensions or settings.lfs_threshold > 0:
+        settings.lfs = LfsStore(settings.lfs_store_path or os.path.join(settings.repo_path, '.git', 'lfs'),
+                                settings.lfs_extensions, settings.lfs_threshold)
+    if settings.repack_interval > 0 or settings.final_repack:
+        settings.maintenance = GitMaintenance(settings.repack_interval, settings.final_repack)
+    if settings.push_interval > 0 or settings.push_minutes > 0:
+        settings.pusher = BackgroundPush(git_repo, [branch for _, _, branch in settings.views],
+                                         settings.push_interval, settings.push_minutes * 60,
+                                         settings.thread_name('push'))
+
+    success = True
+    for index, (view, label, branch) in enumerate(settings.views, 1):
+        if not migrate_view(settings, git_repo, view_name(journal_file_name, index), view, label, branch):
+            success = False
+            break
+        settings.progress.count('views_done')
+
+    if settings.git_backend != GIT_BACKEND_FAST_IMPORT and \
+            (settings.direct_import or len(settings.views) > 1) and git_repo.head.is_valid():
+        # Рабочий каталог приводим к последнему коммиту master, как после обычной загрузки
+        git_switch_branch(git_repo, GIT_BRANCH)
+        git_repo.head.reset(index=True, working_tree=True)
+    if settings.maintenance:
+        settings.maintenance.finish(git_repo)
+    if settings.pusher:
+        settings.pusher.finish()
+    if settings.blob_cache:
+        settings.blob_cache.report()
+        settings.blob_cache.close()
+    if settings.lfs:
+        settings.lfs.report()
+        settings.lfs.close()
+    close_response_cache(settings)
+    settings.broker.report()
+    return success
+
+
+# -------------------------------------------------------------------------------------------------
+class JobRunner:
+    """Перенос нескольких проектов в одном процессе (--jobs). Все проекты делят один бюджет
+    одновременных stcmd (STCMD_LIMITER) и один предел пишущих в git потоков (GIT_WRITERS).
+    Файл заданий - ini с секцией [JOBS], пути к ini проектов задаются относительно него"""
+    def __init__(self, jobs_filename, args):
+        self.jobs_filename = os.path.abspath(jobs_filename)
+        self.args = args
+        self.projects = []
+        self.parallel_jobs = 2
+        self.stcmd_concurrency = 8
+        self.stcmd_min_concurrency = 1
+        self.stcmd_max_concurrency = 16
+        self.git_writers = 1
+        self.report_interval = 60
+        self.retry_limit = 10
+        self.retry_delay = 5
+        self.retry_max_delay = 300
+        self.log_level = LOG_INFO
+        self.log_format = 'text'
+        self.log_max_size = 100 * 1024 * 1024
+        self.log_backups = 5
+        self.metrics_file = ''
+        self.metrics_interval = 60
+        self.jobs = []  # [GlobalSettings]
+        self.states = {}  # имя проекта -> waiting/running/done/failed
+        self.stop_event = threading.Event()
+
+    def read_config(self):
+        section_jobs = 'JOBS'
+        try:
+            parser = configparser.RawConfigParser()
+            if not parser.read(self.jobs_filename, encoding="UTF-8"):
+                raise FileNotFoundError('NOT FOUND {}'.format(self.jobs_filename))
+            jobs_dir = os.path.dirname(self.jobs_filename)
+            self.projects = [os.path.normpath(os.path.join(jobs_dir, line.strip()))
+                             for line in parser.get(section_jobs, 'Projects').splitlines() if line.strip()]
+            if not self.projects:
+                raise ValueError('Projects: no project ini files in {}'.format(self.jobs_filename))
+            self.parallel_jobs = parser.getint(section_jobs, 'ParallelJobs', fallback=self.parallel_jobs)
+            self.stcmd_concurrency = parser.getint(section_jobs, 'StcmdConcurrency', fallback=self.stcmd_concurrency)
+            self.stcmd_min_concurrency = parser.getint(section_jobs, 'StcmdMinConcurrency',
+                                                       fallback=self.stcmd_min_concurrency)
+            self.stcmd_max_concurrency = parser.getint(section_jobs, 'StcmdMaxConcurrency',
+                                                       fallback=self.stcmd_max_concurrency)
+            self.git_writers = parser.getint(section_jobs, 'GitWriters', fallback=self.git_writers)
+            self.report_interval = parser.getint(section_jobs, 'ReportInterval', fallback=self.report_interval)
+            self.retry_limit = parser.getint(section_jobs, 'RetryLimit', fallback=self.retry_limit)
+            self.retry_delay = parser.getint(section_jobs, 'RetryDelay', fallback=self.retry_delay)
+            self.retry_max_delay = parser.getint(section_jobs, 'RetryMaxDelay', fallback=self.retry_max_delay)
+            self.log_level = parser.get(section_jobs, 'LogLevel', fallback=self.log_level).strip().upper()
+            self.log_format = parser.get(section_jobs, 'LogFormat', fallback=self.log_format).strip().lower()
+            self.log_max_size = parser.getint(section_jobs, 'LogMaxSize',
+                                              fallback=self.log_max_size // (1024 * 1024)) * 1024 * 1024
+            self.log_backups = parser.getint(section_jobs, 'LogBackups', fallback=self.log_backups)
+            if self.log_level not in LOG_LEVELS:
+                raise ValueError('UNKNOWN LogLevel "{}" in {}'.format(self.log_level, self.jobs_filename))
+            if self.log_format not in ('text', 'json'):
+                raise ValueError('UNKNOWN LogFormat "{}" in {}'.format(self.log_format, self.jobs_filename))
+            LOGGER.configure(self.log_level, self.log_format == 'json', self.log_max_size, self.log_backups)
+            self.metrics_file = parser.get(section_jobs, 'MetricsFile', fallback=self.metrics_file).strip()
+            if self.metrics_file:
+                self.metrics_file = os.path.join(jobs_dir, self.metrics_file)
+            self.metrics_interval = parser.getint(section_jobs, 'MetricsInterval', fallback=self.metrics_interval)
+        except BaseException as e:
+            log('ERROR when reading jobs file "{}" ({})'.format(self.jobs_filename, e), level=LOG_ERROR)
+            return False
+        return True
+
+    def prepare(self):
+        names = collections.Counter()
+        passwords = {}  # (сервер, порт, логин) -> пароль, спрашиваем один раз
+        for ini_filename in self.projects:
+            root = os.path.dirname(ini_filename)
+            name = os.path.basename(root) or os.path.splitext(os.path.basename(ini_filename))[0]
+            names[name] += 1
+            if names[name] > 1:
+                name = '{}{}'.format(name, names[name])
+            settings = GlobalSettings(ini_filename, root, name)
+            if not settings.was_success():
+                return False
+            # Повторы stcmd общие для всех проектов (STCMD_LIMITER), другие значения в ini проекта не действовали бы
+            retries = (settings.retry_limit, settings.retry_delay, settings.retry_max_delay)
+            if retries != (self.retry_limit, self.retry_delay, self.retry_max_delay):
+                log('ERROR: RetryLimit, RetryDelay, RetryMaxDelay = {} in {} differ from {} in {}: with --jobs they are '
+                    'shared by all projects, set them in [JOBS]'.format(
+                        retries, ini_filename, (self.retry_limit, self.retry_delay, self.retry_max_delay),
+                        self.jobs_filename), level=LOG_ERROR)
+                return False
+            login = (settings.starteam_server, settings.starteam_port, settings.starteam_login)
+            if settings.starteam_password == '' and login in passwords:
+                settings.starteam_password = passwords[login]
+            if not ask_starteam_password(settings):
+                return False
+            passwords.setdefault(login, settings.starteam_password)
+            if settings.response_cache_ttl > 0 or self.args.offline:
+                settings.response_cache = ResponseCache(settings.response_cache_path,
+                                                        settings.response_cache_ttl, self.args.offline)
+            self.jobs.append(settings)
+            self.states[name] = 'waiting'
+        return True
+
+    def run_job(self, settings):
+        threading.current_thread().name = settings.job_name
+        self.states[settings.job_name] = 'running'
+        settings.progress.started = time.time()
+        log('JOB {} STARTED: {} -> {}'.format(settings.job_name, settings.ini_filename, settings.repo_path))
+        try:
+            success = migrate_project(settings, self.args)
+        except Exception as exc:
+            log('ERROR: job {} generated an exception: {}'.format(settings.job_name, exc), level=LOG_ERROR)
+            success = False
+        self.states[settings.job_name] = 'done' if success else 'failed'
+        settings.progress.count('elapsed', time.time() - settings.progress.started)
+        log('JOB {} {}'.format(settings.job_name, self.states[settings.job_name].upper()))
+        return success
+
+    def report(self):
+        lines = ['JOBS PROGRESS:']
+        for settings in self.jobs:
+            counters = settings.progress.snapshot()['counters']
+            state = self.states[settings.job_name]
+            found = counters.get('revisions_found', 0)
+            done = counters.get('revisions_done', 0)
+            elapsed = counters.get('elapsed') or \
+                (time.time() - settings.progress.started if state == 'running' else 0)
+            # Пока обход дерева не закончен, число найденных ревизий растет, и ETA занижена
+            eta = '-'
+            if state == 'running' and done and found > done:
+                eta = format_duration(elapsed * (found - done) / done)
+            lines.append('\t{:<24} {:<8} views {}/{} revisions {}/{} elapsed {} ETA {}'.format(
+                settings.job_name, state, counters.get('views_done', 0), len(settings.views),
+                done, found, format_duration(elapsed), eta))
+        log('\n'.join(lines))
+
+    def reporter(self):
+        while not self.stop_event.wait(self.report_interval):
+            self.report()
+
+    def run(self):
+        global GIT_WRITERS
+        if not self.read_config() or not self.prepare():
+            return False
+        STCMD_LIMITER.configure(self.stcmd_concurrency, self.stcmd_min_concurrency, self.stcmd_max_concurrency,
+                                self.retry_limit, self.retry_delay, self.retry_max_delay)
+        GIT_WRITERS = threading.BoundedSemaphore(max(1, self.git_writers))
+        log('RUNNING {} JOBS, {} at once, stcmd concurrency {}, git writers {}'.format(
+            len(self.jobs), self.parallel_jobs, self.stcmd_concurrency, self.git_writers))
+        if self.report_interval > 0:
+            threading.Thread(target=self.reporter, name='jobs_report', daemon=True).start()
+        # Метрики общие для всех проектов: MetricsFile и MetricsInterval проектов при --jobs не действуют
+        METRICS.start(self.metrics_file, self.metrics_interval)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.parallel_jobs),
+                                                   thread_name_prefix='job') as executor:
+            results = list(executor.map(self.run_job, self.jobs))
+        METRICS.stop()
+        self.stop_event.set()
+        self.report()
+        return all(results)
+
+
+# -------------------------------------------------------------------------------------------------
+def run():
+    args = parse_args()
+    if args.shard:
+        # Лог шарда переименовываем до первой записи
+        LOGGER.file_name = shard_name(LOGGER.file_name, args.shard)
+    log('=' * 120)
+    log('STARTED')
+
+    if args.jobs:
+        success = JobRunner(args.jobs, args).run()
+        METRICS.report()
+        log('FINISHED' if success else 'FINISHED WITH ERRORS')
+        LOGGER.flush()
+        if not success:
+            sys.exit(1)
+        return
+    global_settings = GlobalSettings()
+    if args.merge:
+        success = False
+        if global_settings.was_success() and clean(global_settings.repo_path):
+            git_repo = git_init(global_settings.repo_path, global_settings.git_url)
+            if git_repo:
+                lfs_path = global_settings.lfs_store_path or os.path.join(global_settings.repo_path, '.git', 'lfs')
+                success = all([git_merge_shards(git_repo, args.merge, lfs_path, branch)
+                               for _, _, branch in global_settings.views])
+                GitMaintenance(0, global_settings.final_repack).finish(git_repo)
+        log('FINISHED' if success else 'FINISHED WITH ERRORS')
+        LOGGER.flush()
+        if not success:
+            sys.exit(1)
+        return
+    if args.shard:
+        use_shard_paths(global_settings, args.shard)
+    if global_settings.response_cache_ttl > 0 or args.offline:
+        global_settings.response_cache = ResponseCache(global_settings.response_cache_path,
+                                                       global_settings.response_cache_ttl, args.offline)
+    if args.offline:
+        global_settings.plan_samples = 0  # пробные выгрузки без сервера невозможны
+    if args.plan:
+        if global_settings.was_success() and clean(global_settings.temp_path) and \
+                ask_starteam_password(global_settings):
+            configure_limiter(global_settings)
+            run_plan(global_settings)
+        close_response_cache(global_settings)
+        log('FINISHED')
+        LOGGER.flush()
+        return
+    if args.verify:
+        if not os.path.exists(global_settings.repo_path):
+            log('ERROR: NOTHING TO VERIFY, {} not found'.format(global_settings.repo_path), level=LOG_ERROR)
+        elif global_settings.was_success() and ask_starteam_password(global_settings):
+            configure_limiter(global_settings)
+            run_verify(global_settings, Repo(global_settings.repo_path))
+        close_response_cache(global_settings)
+        log('FINISHED')
+        LOGGER.flush()
+        return
+    if not global_settings.was_success() or not ask_starteam_password(global_settings):
+        return
+    configure_limiter(global_settings)
+    METRICS.start(global_settings.metrics_file, global_settings.metrics_interval)
+    success = migrate_project(global_settings, args)
+    METRICS.stop()
+    METRICS.report()
+    log('FINISHED' if success else 'FINISHED WITH ERRORS')
+    LOGGER.flush()
+    if not success:
+        sys.exit(1)
 
 
 run()
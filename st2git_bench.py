@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Замер производительности st2git без сервера StarTeam: строит синтетический вид заданного размера,
+# запускает полный run() st2git.py с fake_stcmd.py вместо stcmd и выводит files/sec, commits/sec,
+# пиковую память и занятое место на диске. Результат можно сохранить как базовый (--save-baseline)
+# и сравнивать с ним следующие замеры (--baseline).
+#
+#   python st2git_bench.py --folders 50 --files 20 --revisions 10 --size 8192 --latency 0.2
+#   python st2git_bench.py --set GitBackend=fast-import --set ChangesetWindow=300 --baseline base.json
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_stcmd
+
+PATH_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# -------------------------------------------------------------------------------------------------
+def dir_size(path):
+    total = 0
+    for d, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(d, file_name))
+            except OSError:
+                pass  # файл удален, пока обходили каталог
+    return total
+
+
+# -------------------------------------------------------------------------------------------------
+def make_stcmd(work_dir):
+    if os.name == 'nt':
+        stcmd = os.path.join(work_dir, 'stcmd.cmd')
+        with open(stcmd, mode='w') as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, os.path.join(PATH_ROOT, 'fake_stcmd.py')))
+    else:
+        stcmd = os.path.join(work_dir, 'stcmd')
+        with open(stcmd, mode='w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(PATH_ROOT, 'fake_stcmd.py')))
+        os.chmod(stcmd, 0o755)
+    return stcmd
+
+
+# -------------------------------------------------------------------------------------------------
+def write_ini(work_dir, stcmd, view, options):
+    common = {'StarteamServer': 'bench', 'StarteamPort': '49201', 'stcmd': stcmd}
+    common.update(options)
+    lines = ['[COMMON]'] + ['{}={}'.format(key, value) for key, value in common.items()]
+    lines += ['', '[SPECIAL]',
+              'StarteamProject = BENCH',
+              'StarteamView = BENCH_VIEW',
+              'StarteamLogin = bench',
+              'ViewLabel = {}'.format(view['label']),
+              'Git = {}'.format(os.path.join(work_dir, 'origin.git'))]
+    with open(os.path.join(work_dir, 'st2git.ini'), mode='w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+# -------------------------------------------------------------------------------------------------
+def peak_hwm_kb(pid):
+    """Пик резидентной памяти самого процесса (VmHWM) или None, если /proc недоступен.
+    У завершившегося процесса его уже нет, поэтому значение снимается, пока процесс работает"""
+    try:
+        with open('/proc/{}/status'.format(pid), encoding='ascii', errors='replace') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# -------------------------------------------------------------------------------------------------
+def peak_rss_mb(process_rusage):
+    if process_rusage is None:
+        return None
+    # ru_maxrss в Linux в КБ, в macOS в байтах
+    return process_rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# -------------------------------------------------------------------------------------------------
+def run_bench(args):
+    view = fake_stcmd.default_view()
+    view.update({'seed': args.seed, 'folders': args.folders, 'width': args.width, 'files': args.files,
+                 'revisions': args.revisions, 'size': args.size, 'deleted': args.deleted,
+                 'renamed': args.renamed, 'unchanged': args.unchanged, 'latency': args.latency})
+    totals = fake_stcmd.view_totals(view)
+
+    work_dir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='st2git_bench_')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    shutil.copy(os.path.join(PATH_ROOT, 'st2git.py'), work_dir)
+    with open(os.path.join(work_dir, 'view.json'), mode='w', encoding='utf-8') as f:
+        json.dump(view, f)
+    options = dict(option.split('=', 1) for option in args.set)
+    write_ini(work_dir, make_stcmd(work_dir), view, options)
+    # origin - пустой локальный репозиторий, в него отправляет история при PushInterval/PushMinutes
+    subprocess.run(['git', 'init', '-q', '--bare', os.path.join(work_dir, 'origin.git')], check=True)
+
+    env = dict(os.environ, FAKE_STCMD_VIEW=os.path.join(work_dir, 'view.json'), PYCHARM_HOSTED='1')
+    print('Synthetic view: {folders} folders, {files} files, {revisions} revisions'.format(**totals))
+    print('Work dir: {}'.format(work_dir))
+
+    # Пиковый объем временного каталога и пик памяти st2git замеряем в отдельном потоке
+    peak_temp = [0]
+    peak_hwm = [None]
+    finished = threading.Event()
+
+    def watch(pid):
+        while not finished.wait(0.2):
+            peak_temp[0] = max(peak_temp[0], dir_size(os.path.join(work_dir, '_TEMP')))
+            hwm = peak_hwm_kb(pid)
+            if hwm is not None:
+                peak_hwm[0] = max(peak_hwm[0] or 0, hwm)
+
+    started = time.time()
+    with open(os.path.join(work_dir, 'bench_output.txt'), mode='wb') as output:
+        process = subprocess.Popen([sys.executable, os.path.join(work_dir, 'st2git.py')] + args.args.split(),
+                                   cwd=work_dir, env=env, stdin=subprocess.PIPE, stdout=output, stderr=output)
+        watcher = threading.Thread(target=watch, args=(process.pid,), daemon=True)
+        watcher.start()
+        process.communicate(b'bench\n')
+    elapsed = time.time() - started
+    finished.set()
+    watcher.join()
+
+    # Без /proc остается ru_maxrss потомков: это максимум по всем ожидавшимся процессам,
+    # включая stcmd и git, а не память самого st2git
+    peak_rss = peak_hwm[0] / 1024 if peak_hwm[0] is not None else None
+    peak_rss_source = 'st2git'
+    if peak_rss is None and os.name != 'nt':
+        import resource
+        peak_rss = peak_rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN))
+        peak_rss_source = 'max over descendants'
+
+    repo = os.path.join(work_dir, '_REPO')
+    commits = 0
+    head_files = None
+    out_of_order = 0
+    if os.path.exists(os.path.join(repo, '.git')):
+        rev_list = subprocess.run(['git', 'rev-list', '--count', 'HEAD'], cwd=repo,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        commits = int(rev_list.stdout or 0)
+        dates = subprocess.run(['git', 'log', '--reverse', '--format=%at', 'HEAD'], cwd=repo,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        timestamps = [int(line) for line in dates.stdout.split()]
+        out_of_order = sum(1 for previous, current in zip(timestamps, timestamps[1:]) if current < previous)
+        ls_tree = subprocess.run(['git', 'ls-tree', '-r', '--name-only', 'HEAD'], cwd=repo,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # .gitattributes пишет сам st2git (LfsExtensions, LfsThreshold), в виде его нет
+        head_files = len([path for path in ls_tree.stdout.splitlines() if path != b'.gitattributes'])
+    origin_list = subprocess.run(['git', 'rev-list', '--count', '--all'], cwd=os.path.join(work_dir, 'origin.git'),
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    origin_commits = int(origin_list.stdout or 0)
+
+    result = {'view': view,
+              'options': options,
+              'exit_code': process.returncode,
+              'elapsed': elapsed,
+              'revisions': totals['revisions'],
+              'files_per_sec': totals['revisions'] / elapsed if elapsed else 0,
+              'commits': commits,
+              'commits_per_sec': commits / elapsed if elapsed else 0,
+              'out_of_order_commits': out_of_order,
+              'chronological': int(options.get('ChangesetWindow', 0)) > 0,
+              'origin_commits': origin_commits,
+              'head_files': head_files,
+              'expected_head_files': totals['label_files'],
+              'peak_rss_mb': peak_rss,
+              'peak_rss_source': peak_rss_source,
+              'peak_temp_mb': peak_temp[0] / (1024 * 1024),
+              'repo_mb': dir_size(repo) / (1024 * 1024),
+              'git_dir_mb': dir_size(os.path.join(repo, '.git')) / (1024 * 1024)}
+    if not args.keep and not args.workdir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+# -------------------------------------------------------------------------------------------------
+def print_result(result, baseline=None):
+    rows = [('exit code', 'exit_code', '{}'),
+            ('elapsed, sec', 'elapsed', '{:.1f}'),
+            ('revisions', 'revisions', '{}'),
+            ('files/sec', 'files_per_sec', '{:.2f}'),
+            ('commits', 'commits', '{}'),
+            ('commits/sec', 'commits_per_sec', '{:.2f}'),
+            ('out of date order', 'out_of_order_commits', '{}'),
+            ('commits at origin', 'origin_commits', '{}'),
+            ('files at HEAD', 'head_files', '{}'),
+            ('expected at HEAD', 'expected_head_files', '{}'),
+            ('peak RSS, MB' if result.get('peak_rss_source') == 'st2git' else 'max child RSS, MB',
+             'peak_rss_mb', '{:.1f}'),
+            ('peak _TEMP, MB', 'peak_temp_mb', '{:.1f}'),
+            ('_REPO, MB', 'repo_mb', '{:.1f}'),
+            ('_REPO/.git, MB', 'git_dir_mb', '{:.1f}')]
+    for title, key, fmt in rows:
+        value = result[key]
+        line = '{:<18} {:>12}'.format(title, 'n/a' if value is None else fmt.format(value))
+        if baseline and baseline.get(key) not in (None, 0) and value is not None:
+            line += '   baseline {:>12} ({:+.1f}%)'.format(fmt.format(baseline[key]),
+                                                        (value - baseline[key]) * 100.0 / baseline[key])
+        print(line)
+    if not head_matches(result):
+        print('ERROR: HEAD does not match the label snapshot of the synthetic view')
+    if not dates_ordered(result):
+        print('ERROR: commit dates decrease in changeset mode')
+
+
+# -------------------------------------------------------------------------------------------------
+def head_matches(result):
+    # Без репозитория (например, --plan) сравнивать не с чем
+    return result['head_files'] is None or result['head_files'] == result['expected_head_files']
+
+
+# -------------------------------------------------------------------------------------------------
+def dates_ordered(result):
+    # Наборы изменений (ChangesetWindow > 0) коммитятся по времени, без них история идет по папкам
+    return not result['chronological'] or not result['out_of_order_commits']
+
+
+# -------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='st2git benchmark against a fake StarTeam server')
+    parser.add_argument('--folders', type=int, default=10, help='number of folders')
+    parser.add_argument('--width', type=int, default=3, help='subfolders per folder')
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--revisions', type=int, default=5, help='average revisions per file')
+    parser.add_argument('--size', type=int, default=4096, help='average file size, bytes')
+    parser.add_argument('--deleted', type=float, default=0.02, help='share of files deleted from StarTeam')
+    parser.add_argument('--renamed', type=float, default=0.05, help='share of renamed files')
+    parser.add_argument('--unchanged', type=float, default=0.05, help='share of property-only revisions')
+    parser.add_argument('--latency', type=float, default=0.0, help='stcmd startup and login time, sec')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='st2git.ini [COMMON] option, may be repeated')
+    parser.add_argument('--args', default='', help='extra st2git.py command line arguments')
+    parser.add_argument('--workdir', help='work directory (recreated, kept after the run)')
+    parser.add_argument('--keep', action='store_true', help='keep temporary work directory')
+    parser.add_argument('--baseline', help='compare with result saved by --save-baseline')
+    parser.add_argument('--save-baseline', help='save result as JSON')
+    args = parser.parse_args()
+
+    result = run_bench(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_result(result, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, mode='w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1, ensure_ascii=False)
+    return 0 if result['exit_code'] == 0 and head_matches(result) and dates_ordered(result) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())